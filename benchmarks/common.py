@@ -0,0 +1,113 @@
+# Shared helpers for the Yoke benchmarks: synthetic layouts and reports, statistics and JSON output.
+import os
+import sys
+import json
+import random
+import platform
+import subprocess
+import tracemalloc
+from time import perf_counter_ns
+
+# Run against the working tree, not an installed copy of Yoke.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from yoke import events as EVENTS
+from yoke.layout import compile_layout
+
+def event_names(prefixes):
+    # One name per distinct event code, in code order.
+    return [EVENTS.NAMES[e] for e in sorted(EVENTS.NAMES) if EVENTS.NAMES[e].startswith(prefixes)]
+
+AXES = event_names('ABS_')
+BUTTONS = event_names(('BTN_', 'KEY_'))
+
+def make_layout(controls):
+    # Layout handshake with roughly one axis for every three buttons, like the bundled gamepads.
+    axes = min(max(controls // 4, 1), len(AXES), controls)
+    return ','.join(AXES[:axes] + BUTTONS[:controls - axes]).encode()
+
+def layout_events(layout):
+    return compile_layout(layout).events
+
+def make_reports(dev, count, changes=0.25, seed=0):
+    # Status reports for `dev` where each control changes with probability `changes` from one report to the next.
+    rnd = random.Random(seed)
+    values = [0] * len(dev.events)
+    reports = []
+    for _ in range(count):
+        for i, e in enumerate(dev.events):
+            if rnd.random() < changes:
+                values[i] = rnd.randrange(0x8000) if e[0] == 0x03 else not values[i]
+        reports.append(dev.inStruct.pack(*values))
+    return reports
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(int(len(sorted_values) * p / 100), len(sorted_values) - 1)]
+
+def measure(fn, args, repeat=1):
+    # Call fn(a) for every a in args and report throughput, latency percentiles and allocations.
+    # Throughput comes from an untimed pass, so the per-call timer doesn't weigh on it.
+    t0 = perf_counter_ns()
+    for _ in range(repeat):
+        for a in args:
+            fn(a)
+    total = perf_counter_ns() - t0
+    n = repeat * len(args)
+
+    latencies = []
+    for a in args:
+        t = perf_counter_ns()
+        fn(a)
+        latencies.append(perf_counter_ns() - t)
+    latencies.sort()
+
+    # Allocations: bytes allocated by a call at its peak, and blocks still held after it (leaks).
+    tracemalloc.start()
+    blocks = sys.getallocatedblocks()
+    peak = 0
+    for a in args:
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        fn(a)
+        peak += tracemalloc.get_traced_memory()[1] - before
+    blocks = sys.getallocatedblocks() - blocks
+    tracemalloc.stop()
+
+    return {
+        'packets': n,
+        'packets_per_sec': n * 1e9 / total if total else 0,
+        'p50_us': percentile(latencies, 50) / 1000,
+        'p99_us': percentile(latencies, 99) / 1000,
+        'alloc_bytes_per_packet': peak / len(args),
+        'retained_blocks_per_packet': blocks / len(args),
+    }
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def save(path, benchmark, args, results):
+    report = {
+        'benchmark': benchmark,
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'args': vars(args),
+        'results': results,
+    }
+    if path == '-':
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+def print_table(results, columns):
+    print(' '.join('{:>14}'.format(c) for c in columns))
+    for r in results:
+        print(' '.join('{:>14.6g}'.format(r[c]) if isinstance(r[c], float) else '{:>14}'.format(r[c]) for c in columns))
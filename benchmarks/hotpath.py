@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# Micro benchmarks of the per-packet path of yoke.Service, against a fake device (no uinput, no phone):
+#   layout      handling of a layout handshake (what Service.handle does on a new connection)
+#   preprocess  Service.preprocess: decoding a status report
+#   update      Device.update: emitting the decoded values to the device backend
+#   update_from Device.update_from: decoding and emitting a report straight from a receive buffer
+#   handle      Service.handle: the whole path from a received status report to the device
+#
+# Example:
+#   python3 benchmarks/hotpath.py --controls 4 32 128 --output hotpath.json
+import argparse
+import contextlib
+import os
+
+from common import make_layout, make_reports, measure, save, print_table
+
+import yoke
+
+ADDRESS = ('127.0.0.1', 50000)
+
+def bench(controls, args):
+    service = yoke.Service(backend=args.backend)
+    layout = make_layout(controls)
+    results = []
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        service.handle(layout, ADDRESS)
+        session = service.sessions[ADDRESS]
+        def handle_layout(m):
+            session.close()
+            service.handle(m, ADDRESS)
+        results.append(dict(measure(handle_layout, [layout] * args.layouts), stage='layout'))
+
+    dev = session.dev
+    reports = make_reports(dev, args.packets, args.changes)
+    values = [service.preprocess(m, dev) for m in reports]
+    results.append(dict(measure(lambda m: service.preprocess(m, dev), reports, args.repeat), stage='preprocess'))
+    results.append(dict(measure(dev.update, values, args.repeat), stage='update'))
+    views = [memoryview(bytearray(m)) for m in reports]
+    results.append(dict(measure(dev.update_from, views, args.repeat), stage='update_from'))
+    results.append(dict(measure(lambda m: service.handle(m, ADDRESS), reports, args.repeat), stage='handle'))
+
+    service.close()
+    for r in results:
+        r['controls'] = controls
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the packet hot path of Yoke against a fake device.')
+    parser.add_argument('--controls', type=int, nargs='+', default=[4, 32, 128], help='layout sizes to benchmark')
+    parser.add_argument('--packets', type=int, default=10000, help='synthetic status reports per layout')
+    parser.add_argument('--repeat', type=int, default=5, help='passes over the reports for the throughput figures')
+    parser.add_argument('--layouts', type=int, default=200, help='layout handshakes per layout size')
+    parser.add_argument('--changes', type=float, default=0.25, help='probability that a control changes between reports')
+    parser.add_argument('--backend', type=str, default='null', choices=['null', 'recording'], help='fake device backend')
+    parser.add_argument('--output', type=str, default=None, help='write results as JSON to this file ("-" for stdout)')
+    args = parser.parse_args()
+
+    results = []
+    for controls in args.controls:
+        results += bench(controls, args)
+    print_table(results, ['controls', 'stage', 'packets_per_sec', 'p50_us', 'p99_us', 'alloc_bytes_per_packet'])
+    if args.output:
+        save(args.output, 'hotpath', args, results)
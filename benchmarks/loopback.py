@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# Macro benchmark of the receive loop of yoke.Service over loopback UDP, against a fake device.
+# A sender thread plays the phone: it sends the layout handshake, then status reports at a given rate.
+# The receiving side runs the same select()/receive()/handle() cycle as Service.run, without the
+# webserver and zeroconf. Latency is measured from sending a report until Service.handle returns.
+#
+# Example:
+#   python3 benchmarks/loopback.py --controls 4 32 --rates 100 1000 --coalesce --output loopback.json
+import argparse
+import contextlib
+import os
+import random
+import socket
+import struct
+import threading
+from array import array
+from time import perf_counter, perf_counter_ns, sleep
+
+from common import make_layout, layout_events, make_reports, percentile, save, print_table
+
+import yoke
+
+def sender(address, layout, reports, rate, jitter, sent):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.connect(address)
+    sock.send(layout)
+    sleep(0.1)
+    rnd = random.Random(1)
+    t = perf_counter()
+    for i, m in enumerate(reports):
+        t += (1 + jitter * (2 * rnd.random() - 1)) / rate
+        delay = t - perf_counter()
+        if delay > 0:
+            sleep(delay)
+        sent[i] = perf_counter_ns()
+        sock.send(m)
+    sock.close()
+
+def bench(controls, rate, args):
+    service = yoke.Service(iface='127.0.0.1', bufsize=args.buffer, coalesce=args.coalesce, backend=args.backend,
+        batch=args.batch)
+    service.use_socket(service.open_socket())
+
+    # The first axis of every report carries its sequence number, to match it with its send time.
+    layout = make_layout(controls)
+    count = int(rate * args.duration)
+    dev = yoke.Device(events=layout_events(layout), backend='null')
+    reports = [bytearray(m) for m in make_reports(dev, count, args.changes)]
+    for i, m in enumerate(reports):
+        struct.pack_into('>H', m, 1, i % 0x8000)
+    sent = array('q', [0] * count)
+    latencies = []
+
+    thread = threading.Thread(target=sender, daemon=True,
+        args=(service.sock.getsockname(), layout, reports, rate, args.jitter, sent))
+    thread.start()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        while thread.is_alive() or service.sel.select(0.2):
+            if service.sel.select(0.2):
+                for m, address, tread in service.receive():
+                    service.handle(m, address, tread)
+                    if m[0] == 0:
+                        t = perf_counter_ns()
+                        latencies.append(t - sent[struct.unpack_from('>H', m, 1)[0]])
+    duration = (sent[count - 1] - sent[0]) / 1e9 if count > 1 else 1
+
+    service.close()
+    latencies.sort()
+    return {
+        'controls': controls,
+        'rate': rate,
+        'sent': count,
+        'delivered': len(latencies),
+        'delivered_per_sec': len(latencies) / duration,
+        'p50_us': percentile(latencies, 50) / 1000,
+        'p99_us': percentile(latencies, 99) / 1000,
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the Yoke receive loop over loopback UDP against a fake device.')
+    parser.add_argument('--controls', type=int, nargs='+', default=[4, 32, 128], help='layout sizes to benchmark')
+    parser.add_argument('--rates', type=float, nargs='+', default=[100, 1000], help='send rates, in reports per second')
+    parser.add_argument('--duration', type=float, default=3, help='seconds of reports to send for every run')
+    parser.add_argument('--jitter', type=float, default=0.2, help='random variation of the send interval, as a fraction of it')
+    parser.add_argument('--changes', type=float, default=0.25, help='probability that a control changes between reports')
+    parser.add_argument('--buffer', type=int, default=65536, help='socket buffer length, in bytes (must fit the layout handshake)')
+    parser.add_argument('--coalesce', action='store_true', help='apply only the newest status report on each wakeup')
+    parser.add_argument('--backend', type=str, default='null', choices=['null', 'recording'], help='fake device backend')
+    parser.add_argument('--batch', type=int, default=32, help='datagrams read per system call at most')
+    parser.add_argument('--output', type=str, default=None, help='write results as JSON to this file ("-" for stdout)')
+    args = parser.parse_args()
+
+    results = []
+    for controls in args.controls:
+        for rate in args.rates:
+            results.append(bench(controls, rate, args))
+    print_table(results, ['controls', 'rate', 'sent', 'delivered', 'delivered_per_sec', 'p50_us', 'p99_us'])
+    if args.output:
+        save(args.output, 'loopback', args, results)
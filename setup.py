@@ -61,10 +61,12 @@ setup(
     dependency_links=[],
     install_requires=[
         'zeroconf',
-        'python-uinput; platform_system == "Linux"',
     ],
-    extras_require={},
-    scripts=['bin/yoke', 'bin/yoke-enable-uinput', 'bin/yoke-disable-uinput'],
+    extras_require={
+        'numpy': ['numpy'],
+        'brotli': ['brotli'],
+    },
+    scripts=['bin/yoke', 'bin/yoke-loadgen', 'bin/yoke-replay', 'bin/yoke-enable-uinput', 'bin/yoke-disable-uinput'],
     cmdclass={
         'install': PostInstallCommand,
     },
@@ -0,0 +1,60 @@
+# Vectorized processing of many status reports of the same layout at once, for recordings,
+# replays and offline analysis. Needs NumPy, which is optional: pip3 install yoke[numpy]
+from yoke import events as EVENTS
+from yoke.curves import AXIS_MAX
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+def require_numpy():
+    if np is None:
+        raise ImportError('Batch processing of status reports needs NumPy: pip3 install numpy')
+
+def report_dtype(layout):
+    # Structured dtype matching layout.inStruct: the header byte, then one field per control,
+    # named after its event (with its position appended when an event appears more than once).
+    require_numpy()
+    names = [EVENTS.name(e) for e in layout.events]
+    fields = [('header', 'u1')]
+    for i, (name, a) in enumerate(zip(names, layout.absmask)):
+        if names.count(name) > 1:
+            name = '{}_{}'.format(name, i)
+        fields.append((name, '>u2' if a else '?'))
+    dtype = np.dtype(fields)
+    assert dtype.itemsize == layout.inStruct.size
+    return dtype
+
+def decode(layout, buffer):
+    # Structured array over a contiguous buffer of status reports, without copying it.
+    dtype = report_dtype(layout)
+    if len(buffer) % dtype.itemsize:
+        raise ValueError('Buffer of {} bytes is not a whole number of {}-byte reports'.format(len(buffer), dtype.itemsize))
+    return np.frombuffer(buffer, dtype=dtype)
+
+def values(reports):
+    # (reports, controls) array of the values of decoded reports, as Device.update takes them.
+    names = reports.dtype.names[1:]
+    out = np.empty((len(reports), len(names)), dtype=np.int32)
+    for i, name in enumerate(names):
+        out[:, i] = reports[name]
+    return out
+
+def apply_curves(values, tables):
+    # Vectorized counterpart of the response curves applied by Device.update (see Curves.tables).
+    # Maps `values` in place and returns it.
+    if tables is not None:
+        for i, table in enumerate(tables):
+            if table is not None:
+                values[:, i] = np.frombuffer(table, dtype=np.uint16)[values[:, i] & AXIS_MAX]
+    return values
+
+def changes(values, state=None):
+    # Mask of the controls that changed in every report, compared with the previous report
+    # (or with `state` for the first one; by default, every control of the first report changed).
+    # Its rows with any change are the reports for which Device.update emits a SYN.
+    changed = np.empty(values.shape, dtype=bool)
+    changed[1:] = values[1:] != values[:-1]
+    changed[0] = True if state is None else values[0] != np.asarray(state)
+    return changed
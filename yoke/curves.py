@@ -0,0 +1,101 @@
+# Response curves for absolute axes: deadzones, exponential curves, scaling and inversion.
+# Every curve is turned into a lookup table with one entry per possible axis value, so that
+# applying it to a status report costs a single index per axis, whatever the curve.
+from array import array
+from functools import lru_cache
+import json
+from yoke import events as EVENTS
+
+AXIS_MAX = 0x7fff # axes range from 0 to AXIS_MAX (see Layout.capabilities)
+
+# deadzone: fraction of the range (around the center, or at the start if not centered) that maps to rest
+# expo: 0 for a linear response, up to 1 for a cubic one (finer control near rest)
+# scale: multiplies the output (saturating at the ends of the range)
+# invert: reverses the axis
+# centered: whether the axis rests at its center (sticks) or at 0 (pedals, triggers)
+DEFAULT_SPEC = {'deadzone': 0.0, 'expo': 0.0, 'scale': 1.0, 'invert': False, 'centered': True}
+
+class CurveError(ValueError): pass
+
+@lru_cache(maxsize=None)
+def build_table(deadzone=0.0, expo=0.0, scale=1.0, invert=False, centered=True):
+    table = array('H', [0]) * (AXIS_MAX + 1)
+    for v in range(AXIS_MAX + 1):
+        x = v / AXIS_MAX
+        if centered:
+            x = 2 * x - 1
+        sign = -1 if x < 0 else 1
+        x = max(abs(x) - deadzone, 0) / (1 - deadzone)
+        x = (1 - expo) * x + expo * x ** 3
+        x = sign * min(x * scale, 1)
+        if invert:
+            x = -x if centered else 1 - x
+        if centered:
+            x = (x + 1) / 2
+        table[v] = round(x * AXIS_MAX)
+    return table
+
+def check_spec(spec):
+    unknown = set(spec) - set(DEFAULT_SPEC)
+    if unknown:
+        raise CurveError('Unknown curve parameters: ' + ', '.join(sorted(unknown)))
+    spec = dict(DEFAULT_SPEC, **spec)
+    try:
+        for key in ('deadzone', 'expo', 'scale'):
+            spec[key] = float(spec[key])
+        for key in ('invert', 'centered'):
+            if isinstance(spec[key], str):
+                spec[key] = spec[key].lower() in ('1', 'true', 'yes', 'on')
+            spec[key] = bool(spec[key])
+    except (TypeError, ValueError):
+        raise CurveError('Curve parameters must be numbers (deadzone, expo, scale) or booleans (invert, centered)')
+    if not 0 <= spec['deadzone'] < 1:
+        raise CurveError('deadzone must be at least 0 and less than 1')
+    if not 0 <= spec['expo'] <= 1:
+        raise CurveError('expo must be between 0 and 1')
+    if spec['scale'] <= 0:
+        raise CurveError('scale must be positive')
+    return spec
+
+def parse_curve(text):
+    # "AXIS:param=value,param=value", e.g. "ABS_X:deadzone=0.1,expo=0.5" or "j1:deadzone=0.1".
+    axis, sep, params = text.partition(':')
+    if not sep:
+        raise CurveError('Expected AXIS:param=value,… but got "{}"'.format(text))
+    spec = {}
+    for param in filter(None, params.split(',')):
+        key, sep, value = param.partition('=')
+        spec[key.strip()] = value.strip() if sep else 'true'
+    return axis.strip(), spec
+
+class Curves:
+    # Curve specs by axis name. An axis can also be given by a layout alias (e.g. "j1" for both
+    # axes of the first joystick), and "*" sets the curve for every axis without one of its own.
+    def __init__(self, specs=None):
+        self.specs = {}
+        for axis, spec in (specs or {}).items():
+            self.set(axis, spec)
+
+    @classmethod
+    def load(cls, path):
+        # JSON file with an object of specs by axis, e.g. {"j1": {"deadzone": 0.1}, "ABS_GAS": {"centered": false}}
+        with open(path) as f:
+            specs = json.load(f)
+        if not isinstance(specs, dict) or not all(isinstance(s, dict) for s in specs.values()):
+            raise CurveError('{} must contain an object of curve parameters by axis'.format(path))
+        return cls(specs)
+
+    def set(self, axis, spec):
+        spec = check_spec(spec)
+        for name in EVENTS.ALIAS.get(axis, axis).split(','):
+            if name != '*' and EVENTS.CODES.get(name) not in EVENTS.ABS_EVENTS:
+                raise CurveError('{} is not an absolute axis'.format(name))
+            self.specs[name] = spec
+
+    def tables(self, events):
+        # Lookup table for every event (None for buttons and axes without curve), or None if there's no table at all.
+        tables = []
+        for e in events:
+            spec = self.specs.get(EVENTS.name(e), self.specs.get('*'))
+            tables.append(build_table(**spec) if spec is not None and e in EVENTS.ABS_EVENTS else None)
+        return tables if any(t is not None for t in tables) else None
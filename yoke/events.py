@@ -653,3 +653,23 @@ ALIAS = {
 'b24': 'BTN_TRIGGER',
 'dp': 'BTN_DPAD_UP,BTN_DPAD_LEFT,BTN_DPAD_DOWN,BTN_DPAD_RIGHT',
 }
+
+# Indexes over the events above, built once at import:
+# CODES maps names to events, NAMES maps events back to (the first of) their names,
+# and TYPES maps every event type to the frozenset of its events.
+def _index(namespace):
+    codes, names, types = {}, {}, {}
+    for name, event in list(namespace.items()):
+        if name.isupper() and isinstance(event, tuple):
+            codes[name] = event
+            names.setdefault(event, name)
+            types.setdefault(event[0], set()).add(event)
+    return codes, names, {t: frozenset(events) for t, events in types.items()}
+
+CODES, NAMES, TYPES = _index(globals())
+KEY_EVENTS = TYPES[0x01]
+REL_EVENTS = TYPES[0x02]
+ABS_EVENTS = TYPES[0x03]
+
+def name(event):
+    return NAMES.get(tuple(event[:2]), str(event))
@@ -0,0 +1,55 @@
+# Compilation of the layout handshakes sent by the phone into what Device needs to drive a virtual device.
+import struct
+from functools import lru_cache
+from yoke import events as EVENTS
+
+ABS_EVENTS = EVENTS.ABS_EVENTS
+# Axes that rest at 0 on the phone: pedals and analog buttons. The others (sticks, motion, knobs) rest
+# at AXIS_CENTER, the center of their range, as sent by the joypad when they're released.
+RESTING_AT_ZERO = frozenset(EVENTS.CODES[n] for n in ('ABS_GAS', 'ABS_BRAKE', 'ABS_THROTTLE',
+    'ABS_HAT0X', 'ABS_HAT0Y', 'ABS_HAT1X', 'ABS_HAT1Y', 'ABS_HAT2X', 'ABS_HAT2Y', 'ABS_HAT3X', 'ABS_HAT3Y'))
+AXIS_CENTER = 0x4000
+
+class InvalidLayoutError(Exception): pass
+
+class Layout:
+    # A control layout: its events (in order and as a set), the struct of its status reports,
+    # which of its controls are absolute axes and the capabilities to register for the virtual device.
+    def __init__(self, events):
+        self.events = tuple(events)
+        self.eventset = frozenset(self.events)
+        self.absmask = tuple(e in ABS_EVENTS for e in self.events)
+        self.inStruct = struct.Struct('>x' + ''.join(['H' if a else '?' for a in self.absmask]))
+        # (index, offset of its first byte, of its second byte or None if it's a button) of every control in the reports
+        self.fields = []
+        offset = 1
+        for i, a in enumerate(self.absmask):
+            self.fields.append((i, offset, offset + 1 if a else None))
+            offset += 2 if a else 1
+        self.fields = tuple(self.fields)
+        # raw value of every control at rest (buttons released)
+        self.neutral = tuple(0 if not a or e in RESTING_AT_ZERO else AXIS_CENTER for e, a in zip(self.events, self.absmask))
+        # set range (0, 0x7fff) for abs events
+        self.capabilities = tuple(e + (0, 0x7fff, 0, 0) if a else e for e, a in zip(self.events, self.absmask))
+
+def tokenize(bytestring):
+    # A handshake is a comma-separated list of controls. Every control is either an alias from
+    # EVENTS.ALIAS (possibly standing for several events) or the name of an event.
+    names = []
+    for token in bytestring.decode(encoding='UTF-8').split(','):
+        names += EVENTS.ALIAS.get(token, token).split(',')
+    return names
+
+@lru_cache(maxsize=64)
+def compile_layout(bytestring):
+    # Compiled layouts are cached by handshake, so that phones reconnecting with a known layout
+    # skip the parsing altogether.
+    try:
+        names = tokenize(bytestring)
+    except UnicodeDecodeError:
+        raise InvalidLayoutError(bytestring)
+    try:
+        events = [EVENTS.CODES[n] for n in names]
+    except KeyError:
+        raise InvalidLayoutError(bytestring)
+    return Layout(events)
@@ -0,0 +1,263 @@
+# Always-on instrumentation of Service: packet counters and latency histograms.
+#
+# Everything lives in one fixed-size array of unsigned 64-bit integers, so that counting costs
+# an index and an addition, and so that worker processes can keep theirs in memory shared
+# with the parent process, which adds them up.
+from math import ceil
+from time import time
+import socket
+
+COUNTERS = (
+    'received',  # datagrams read from the socket
+    'reports',   # status reports applied to a device
+    'stale',     # status reports superseded by a newer one from the same peer before being applied
+    'dropped',   # datagrams ignored: empty, from peers without a session (e.g. while every device is in use),
+                 # and layouts whose device couldn't be created
+    'malformed', # datagrams dropped as malformed: status reports too short, and invalid layouts
+    'emits',     # input events emitted to the virtual devices
+)
+RECEIVED, REPORTS, STALE, DROPPED, MALFORMED, EMITS = range(len(COUNTERS))
+
+HISTOGRAMS = (
+    'jitter',  # variation between consecutive inter-arrival times of status reports, per peer
+    'latency', # time from the arrival of a status report to flushing its events to the device
+    'queue',   # time from the arrival of a datagram to reading it (only with kernel timestamps)
+)
+
+SESSION_FIELDS = (
+    'state',    # FREE, CONNECTED or KEPT
+    'host',     # IPv4 address of the phone, as an integer
+    'port',
+    'tconnect', # when the phone connected (time() time)
+    'received', # status reports received
+    'emits',    # input events emitted to the device
+    'controls', # number of controls of the layout, 0 until the phone sends it
+)
+STATE, HOST, PORT, TCONNECT, SESSION_RECEIVED, SESSION_EMITS, CONTROLS = range(len(SESSION_FIELDS))
+FREE, CONNECTED, KEPT = range(3)
+STATES = ('free', 'connected', 'kept')
+# Bytes kept of the layout handshake of every session (with its length in the first two), so that
+# another worker process can take over the session. Longer handshakes aren't kept.
+LAYOUT_SIZE = 1024
+
+# Upper bounds of the histogram buckets exported to Prometheus, in seconds.
+PROMETHEUS_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+class Histogram:
+    # HDR-style histogram of non-negative integers (microseconds, here) in a fixed array:
+    # values below 2*SUB each get a bucket, larger ones share SUB buckets per power of two,
+    # which keeps the relative error under 1/SUB. Values of MAX_BITS bits or more are clamped.
+    SUB_BITS = 4
+    SUB = 1 << SUB_BITS
+    MAX_BITS = 32 # a bit over an hour, in microseconds
+    buckets = (MAX_BITS - SUB_BITS + 1) * SUB
+    slots = 3 + buckets # count, sum, max, buckets
+    vmax = (1 << MAX_BITS) - 1
+
+    def __init__(self, data):
+        self.data = data # memoryview of `slots` unsigned 64-bit integers
+
+    def record(self, v):
+        if v > self.vmax:
+            v = self.vmax
+        data = self.data
+        data[0] += 1
+        data[1] += v
+        if v > data[2]:
+            data[2] = v
+        shift = v.bit_length() - self.SUB_BITS - 1
+        if shift < 0:
+            shift = 0
+        data[3 + (shift << self.SUB_BITS) + (v >> shift)] += 1
+
+    @classmethod
+    def bounds(cls, i):
+        # Lowest and highest value counted in bucket i.
+        shift = max((i >> cls.SUB_BITS) - 1, 0)
+        low = (i - (shift << cls.SUB_BITS)) << shift
+        return low, low + (1 << shift) - 1
+
+    @property
+    def count(self):
+        return self.data[0]
+
+    @property
+    def max(self):
+        return self.data[2]
+
+    def mean(self):
+        return self.data[1] / self.data[0] if self.data[0] else 0
+
+    def percentile(self, p):
+        # Highest value equivalent (within the error of the bucket) to the p-th percentile.
+        count = self.data[0]
+        if count == 0:
+            return 0
+        target = max(ceil(p / 100 * count), 1)
+        total = 0
+        for i in range(self.buckets):
+            total += self.data[3 + i]
+            if total >= target:
+                return min(self.bounds(i)[1], self.data[2])
+        return self.data[2]
+
+    def cumulative(self, v):
+        # Number of values recorded in the buckets that end at or below v.
+        total = 0
+        for i in range(self.buckets):
+            if self.bounds(i)[1] > v:
+                break
+            total += self.data[3 + i]
+        return total
+
+    def add(self, other):
+        self.data[0] += other.data[0]
+        self.data[1] += other.data[1]
+        self.data[2] = max(self.data[2], other.data[2])
+        for i in range(3, self.slots):
+            self.data[i] += other.data[i]
+
+    def snapshot(self):
+        return dict(count=self.count, mean=self.mean(), p50=self.percentile(50), p90=self.percentile(90),
+            p99=self.percentile(99), max=self.max)
+
+class Metrics:
+    size = 8 * (len(COUNTERS) + len(HISTOGRAMS) * Histogram.slots) # bytes
+
+    def __init__(self, buffer=None):
+        # buffer: writable buffer of `size` bytes to keep the metrics in, e.g. a slice of shared memory.
+        self.buffer = bytearray(self.size) if buffer is None else buffer
+        data = memoryview(self.buffer).cast('Q')
+        self.counters = data[:len(COUNTERS)]
+        offset = len(COUNTERS)
+        self.histograms = {}
+        for name in HISTOGRAMS:
+            self.histograms[name] = Histogram(data[offset:offset + Histogram.slots])
+            offset += Histogram.slots
+        self.jitter = self.histograms['jitter']
+        self.latency = self.histograms['latency']
+        self.queue = self.histograms['queue']
+        self.tstart = time()
+
+    @classmethod
+    def total(cls, metrics):
+        # Metrics adding up several others, e.g. those of every worker process.
+        result = cls()
+        for m in metrics:
+            for i in range(len(COUNTERS)):
+                result.counters[i] += m.counters[i]
+            for name in HISTOGRAMS:
+                result.histograms[name].add(m.histograms[name])
+            result.tstart = min(result.tstart, m.tstart)
+        return result
+
+    def snapshot(self):
+        # Plain dictionary of every counter and histogram summary, for programmatic use.
+        snapshot = dict(zip(COUNTERS, self.counters.tolist()))
+        snapshot['uptime'] = time() - self.tstart
+        for name, histogram in self.histograms.items():
+            snapshot[name] = histogram.snapshot()
+        return snapshot
+
+    def summary(self, previous=None, elapsed=None):
+        # One line for the log. Rates are per second since the start, or since `previous`
+        # (a copy of the counters taken `elapsed` seconds ago) if given.
+        if previous is None:
+            previous = (0,) * len(COUNTERS)
+            elapsed = time() - self.tstart
+        elapsed = max(elapsed, 1e-9)
+        delta = [now - before for now, before in zip(self.counters, previous)]
+        return ('{:.1f} packets/s ({} stale, {} dropped, {} malformed), {:.1f} events/s, '
+            'jitter p50 {:.2f} ms p99 {:.2f} ms, latency p50 {} µs p99 {} µs{}').format(
+            delta[RECEIVED] / elapsed, delta[STALE], delta[DROPPED], delta[MALFORMED], delta[EMITS] / elapsed,
+            self.jitter.percentile(50) / 1000, self.jitter.percentile(99) / 1000,
+            self.latency.percentile(50), self.latency.percentile(99),
+            ' (queued p50 {} µs p99 {} µs)'.format(self.queue.percentile(50), self.queue.percentile(99))
+            if self.queue.count else '')
+
+class SessionTable:
+    # Per device id slots of SESSION_FIELDS, as doubles, describing the session using the id,
+    # followed by the layout handshake of every session.
+    # Like Metrics, it can live in memory shared between worker processes.
+    def __init__(self, count, buffer=None):
+        self.buffer = bytearray(self.size(count)) if buffer is None else buffer
+        n = len(SESSION_FIELDS)
+        view = memoryview(self.buffer)
+        data = view[:8 * n * count].cast('d')
+        self.slots = [data[i * n:(i + 1) * n] for i in range(count)]
+        offset = 8 * n * count
+        self.layouts = [view[offset + i * LAYOUT_SIZE:offset + (i + 1) * LAYOUT_SIZE] for i in range(count)]
+
+    @staticmethod
+    def size(count):
+        return (8 * len(SESSION_FIELDS) + LAYOUT_SIZE) * count
+
+    def set_layout(self, i, bytestring):
+        if len(bytestring) > LAYOUT_SIZE - 2:
+            bytestring = b''
+        self.layouts[i][2:2 + len(bytestring)] = bytestring
+        self.layouts[i][:2] = len(bytestring).to_bytes(2, 'big')
+
+    def layout(self, i):
+        # Layout handshake of the session using id i, b'' if unknown.
+        return bytes(self.layouts[i][2:2 + int.from_bytes(self.layouts[i][:2], 'big')])
+
+    def snapshot(self, names, now=None):
+        # List of dictionaries describing the session of every id, given the names of the devices.
+        now = time() if now is None else now
+        devices = []
+        for name, slot in zip(names, self.slots):
+            state, host, port, tconnect, received, emits, controls = slot.tolist()
+            device = dict(name=name, state=STATES[int(state)])
+            if state != FREE:
+                duration = max(now - tconnect, 1e-9)
+                device.update(address='{}:{}'.format(socket.inet_ntoa(int(host).to_bytes(4, 'big')), int(port)),
+                    connected=duration, received=int(received), rate=received / duration, emits=int(emits),
+                    controls=int(controls))
+            devices.append(device)
+        return devices
+
+def prometheus(metrics, devices, uptime):
+    # Prometheus text exposition of a list of (labels, Metrics) and of device snapshots.
+    lines = []
+    def family(name, type, help, samples):
+        lines.append('# HELP {} {}'.format(name, help))
+        lines.append('# TYPE {} {}'.format(name, type))
+        for suffix, labels, value in samples:
+            labels = ','.join('{}="{}"'.format(k, v) for k, v in labels.items())
+            lines.append('{}{}{} {}'.format(name, suffix, '{' + labels + '}' if labels else '', value))
+
+    family('yoke_uptime_seconds', 'gauge', 'Seconds since the service started.', [('', {}, uptime)])
+    helps = dict(received='Datagrams read from the socket.', reports='Status reports applied to a device.',
+        stale='Status reports superseded by a newer one before being applied.',
+        dropped='Datagrams ignored: empty, from peers without a session (e.g. while every device is in use), '
+            'and layouts whose device could not be created.',
+        malformed='Datagrams dropped as malformed: status reports too short, and invalid layouts.',
+        emits='Input events emitted to the virtual devices.')
+    for i, counter in enumerate(COUNTERS):
+        name = 'yoke_events_emitted_total' if counter == 'emits' else 'yoke_packets_{}_total'.format(counter)
+        family(name, 'counter', helps[counter], [('', labels, m.counters[i]) for labels, m in metrics])
+    helps = dict(jitter='Variation between consecutive inter-arrival times of status reports.',
+        latency='Time from the arrival of a status report to flushing its events to the device.',
+        queue='Time from the arrival of a datagram in the kernel to reading it.')
+    for histogram in HISTOGRAMS:
+        samples = []
+        for labels, m in metrics:
+            h = m.histograms[histogram]
+            for le in PROMETHEUS_BUCKETS:
+                samples.append(('_bucket', dict(labels, le=le), h.cumulative(le * 1e6)))
+            samples.append(('_bucket', dict(labels, le='+Inf'), h.count))
+            samples.append(('_sum', labels, h.data[1] / 1e6))
+            samples.append(('_count', labels, h.count))
+        family('yoke_{}_seconds'.format(histogram), 'histogram', helps[histogram], samples)
+
+    family('yoke_device_connected', 'gauge', 'Whether a phone uses the device (1), the device is kept for it (0.5) or free (0).',
+        [('', dict(device=d['name']), {'free': 0, 'connected': 1, 'kept': 0.5}[d['state']]) for d in devices])
+    used = [d for d in devices if d['state'] != 'free']
+    family('yoke_device_packets_received_total', 'counter', 'Status reports received from the phone using the device.',
+        [('', dict(device=d['name'], address=d['address']), d['received']) for d in used])
+    family('yoke_device_packets_per_second', 'gauge', 'Status reports received per second since the phone connected.',
+        [('', dict(device=d['name'], address=d['address']), d['rate']) for d in used])
+    family('yoke_device_events_emitted_total', 'counter', 'Input events emitted to the device.',
+        [('', dict(device=d['name'], address=d['address']), d['emits']) for d in used])
+    return '\n'.join(lines) + '\n'
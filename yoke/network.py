@@ -1,12 +1,33 @@
 from zeroconf import ServiceBrowser, Zeroconf, InterfaceChoice, ServiceInfo
 import socket
 
-zeroconf = Zeroconf()
+# Created on first use, as it starts threads: importing yoke alone (e.g. for yoke.layout) doesn't.
+zeroconf = None
+
+def get_zeroconf():
+    global zeroconf
+    if zeroconf is None:
+        zeroconf = Zeroconf()
+    return zeroconf
 
 # Webserver to serve files to android client
 from http.server import HTTPServer, SimpleHTTPRequestHandler
 import socketserver
 import os, urllib, posixpath
+import hashlib
+import tempfile
+from time import localtime, monotonic
+from collections import OrderedDict
+from threading import Lock
+import io
+import email.utils
+import gzip
+import zipfile
+try:
+    import brotli
+except ImportError:
+    brotli = None # optional, gzip only
+import shutil
 import json
 
 # TODO: These three lines allow using the syntax with socketserver with
@@ -17,8 +38,271 @@ if not "__enter__" in dir(socketserver.BaseServer):
     socketserver.BaseServer.__enter__ = lambda self: self
     socketserver.BaseServer.__exit__ = lambda self, *args: self.server_close()
 
+class FileCache:
+    # LRU cache of the contents of small files, keyed by path and validated by size and mtime,
+    # so that frequently requested assets are served from memory. Shared by the server threads.
+    def __init__(self, maxbytes=16 << 20, maxfile=1 << 20):
+        self.maxbytes = maxbytes
+        self.maxfile = maxfile # larger files are never cached
+        self.entries = OrderedDict() # path -> (size, mtime_ns, contents)
+        self.size = 0
+        self.lock = Lock()
+
+    def get(self, path, st):
+        # Contents of the file at path with stat result st, or None if they aren't cached.
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None or entry[:2] != (st.st_size, st.st_mtime_ns):
+                return None
+            self.entries.move_to_end(path)
+            return entry[2]
+
+    def put(self, path, st, contents):
+        if len(contents) > self.maxfile:
+            return
+        with self.lock:
+            old = self.entries.pop(path, None)
+            if old is not None:
+                self.size -= len(old[2])
+            self.entries[path] = (st.st_size, st.st_mtime_ns, contents)
+            self.size += len(contents)
+            while self.size > self.maxbytes:
+                _, (_, _, evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+class ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    # A thread per connection, so that a slow phone or a kept-alive connection doesn't hold up the others.
+    daemon_threads = True
+
 class HTTPRequestHandler(SimpleHTTPRequestHandler):
     basepath = os.getcwd()
+    # Keep connections alive: a phone downloads many files in a row.
+    protocol_version = 'HTTP/1.1'
+    # But not forever: close connections idle for that many seconds, which would each hold a thread.
+    timeout = 30
+    files = FileCache()
+    # Dynamic pages: path -> function returning a content type and a body.
+    # Bodies are cached for endpoint_ttl seconds, so that frequent requests don't cost more.
+    endpoints = {}
+    endpoint_ttl = 1
+    cache = {}
+
+    # Files by content hash: hash -> (relative path, size, mtime, compressed variants), from check_webserver(),
+    # and the other way around: relative path -> hash.
+    hashes = {}
+    paths = {}
+    manifest = None # contents of manifest.json, from check_webserver()
+    bundle_lock = Lock()
+    extra_headers = ()
+    range = None # (offset, length) of the part of the file to send
+
+    def send_head(self):
+        self.extra_headers = ()
+        self.range = None
+        path = self.path.split('?',1)[0]
+        if path == BUNDLE_PATH or path.startswith(BUNDLE_PREFIX):
+            return self.send_bundle(path)
+        if path.startswith(HASH_PREFIX):
+            digest = path[len(HASH_PREFIX):]
+            entry = self.hashes.get(digest)
+            try:
+                st = os.stat(os.path.join(self.basepath, *entry[0].split('/'))) if entry is not None else None
+            except OSError:
+                st = None
+            # A file changed since the scan doesn't have that hash anymore.
+            if st is None or (st.st_size, st.st_mtime) != entry[1:3]:
+                self.send_error(404, 'File not found')
+                return None
+            self.path = '/' + urllib.parse.quote(entry[0])
+            # Contents at this address never change, so clients can keep them forever.
+            self.extra_headers = (('Cache-Control', 'public, max-age=31536000, immutable'),)
+        return self.send_file()
+
+    def send_file(self):
+        # Like SimpleHTTPRequestHandler.send_head() for regular files, but small files come from the
+        # memory cache, and large ones are left open for copyfile() to send with sendfile().
+        # Directories (listings, index files, redirections) are left to SimpleHTTPRequestHandler.
+        path = self.translate_path(self.path)
+        if path.endswith('/') or os.path.isdir(path):
+            return super().send_head()
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.send_error(404, 'File not found')
+            return None
+        # Files unchanged since the scan have a known hash, which makes a strong ETag,
+        # and maybe compressed variants. Other files get an ETag from their mtime and size.
+        digest = self.paths.get(os.path.relpath(path, self.basepath).replace(os.sep, '/'))
+        entry = self.hashes.get(digest)
+        if entry is not None and (st.st_size, st.st_mtime) == entry[1:3]:
+            etag = digest
+            variants = entry[3]
+        else:
+            etag = '{:x}-{:x}'.format(st.st_mtime_ns, st.st_size)
+            variants = {}
+        ctype = self.guess_type(path)
+        headers = []
+        encoding = self.choose_encoding(variants)
+        if encoding is not None:
+            try:
+                st, path = os.stat(variants[encoding]), variants[encoding]
+            except OSError:
+                encoding = None # removed since the scan: send the file itself
+        if encoding is not None:
+            etag += '-' + encoding # every representation needs its own ETag
+            headers.append(('Content-Encoding', encoding))
+        if variants:
+            headers.append(('Vary', 'Accept-Encoding'))
+        self.extra_headers += tuple(headers)
+        return self.send_contents(path, st, ctype, etag)
+
+    def send_bundle(self, path):
+        tree = self.manifest['tree'] if self.manifest is not None else None
+        if tree is None or path not in (BUNDLE_PATH, BUNDLE_PREFIX + tree + '.zip'):
+            self.send_error(404, 'File not found')
+            return None
+        with self.bundle_lock:
+            filename = build_bundle(self.basepath, self.manifest)
+        if filename is None:
+            self.send_error(503, 'Files changed since Yoke started, restart it to update the bundle')
+            return None
+        if path != BUNDLE_PATH:
+            self.extra_headers = (('Cache-Control', 'public, max-age=31536000, immutable'),)
+        return self.send_contents(filename, os.stat(filename), 'application/zip', tree)
+
+    def send_contents(self, path, st, ctype, etag):
+        # Send the headers for the file at path with stat result st, which is served as ctype and has
+        # the given ETag, and return a file object of its contents, or None if there is nothing to send.
+        # Answers conditional requests, and requests for a single byte range (e.g. to resume a download).
+        self.extra_headers += (('ETag', '"{}"'.format(etag)), ('Accept-Ranges', 'bytes'))
+        if self.not_modified(st, etag):
+            self.send_response(304)
+            self.end_headers()
+            return None
+        contents = self.files.get(path, st)
+        if contents is None:
+            try:
+                f = open(path, 'rb')
+            except OSError:
+                self.extra_headers = ()
+                self.send_error(404, 'File not found')
+                return None
+            if st.st_size > self.files.maxfile:
+                source = f
+            else:
+                with f:
+                    contents = f.read()
+                self.files.put(path, st, contents)
+        if contents is not None:
+            source = io.BytesIO(contents)
+        size = st.st_size if contents is None else len(contents)
+        requested = self.requested_range(size, etag, st)
+        if requested is False:
+            source.close()
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */{}'.format(size))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+        start, end = requested or (0, size)
+        self.range = (start, end - start)
+        self.send_response(206 if requested else 200)
+        self.send_header('Content-type', ctype)
+        self.send_header('Content-Length', str(end - start))
+        if requested:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end - 1, size))
+        self.send_header('Last-Modified', self.date_time_string(st.st_mtime))
+        self.end_headers()
+        return source
+
+    def requested_range(self, size, etag, st):
+        # (start, end) of the single byte range requested, None to send everything,
+        # or False if the range is beyond the end of the file.
+        value = self.headers.get('Range', '').replace(' ', '')
+        if not value.startswith('bytes=') or ',' in value:
+            return None # no range, or several ranges, which we don't bother with
+        validator = self.headers.get('If-Range')
+        if validator is not None and validator.strip() not in ('"{}"'.format(etag), self.date_time_string(st.st_mtime)):
+            return None # the part the client has is from another version
+        first, _, last = value[len('bytes='):].partition('-')
+        try:
+            if first:
+                start, end = int(first), int(last) + 1 if last else size
+            else:
+                start, end = size - int(last), size
+        except ValueError:
+            return None
+        start, end = max(start, 0), min(end, size)
+        if start >= end:
+            return False
+        return start, end
+
+    def choose_encoding(self, variants):
+        # The preferred content coding among the variants that the client accepts, if any.
+        if not variants:
+            return None
+        accepted = set()
+        for coding in self.headers.get('Accept-Encoding', '').split(','):
+            coding, _, params = coding.strip().partition(';')
+            if params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+                accepted.add(coding.strip().lower())
+        for encoding, suffix, compress in ENCODINGS:
+            if encoding in variants and (encoding in accepted or '*' in accepted):
+                return encoding
+        return None
+
+    def not_modified(self, st, etag):
+        # Whether the client's copy, as described by If-None-Match or else If-Modified-Since, is still current.
+        match = self.headers.get('If-None-Match')
+        if match is not None:
+            tags = [tag.strip() for tag in match.split(',')]
+            # Weak comparison, as for GET and HEAD requests.
+            return '*' in tags or '"{}"'.format(etag) in [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+        since = self.headers.get('If-Modified-Since')
+        if since is None:
+            return False
+        try:
+            since = email.utils.parsedate_to_datetime(since)
+        except (TypeError, IndexError, OverflowError, ValueError):
+            return False
+        if since.tzinfo is None:
+            return False
+        return int(st.st_mtime) <= since.timestamp()
+
+    def copyfile(self, source, outputfile):
+        if self.range is None:
+            shutil.copyfileobj(source, outputfile)
+            return
+        offset, count = self.range
+        if isinstance(source, io.BytesIO):
+            outputfile.write(source.getbuffer()[offset:offset + count])
+        else:
+            self.wfile.flush()
+            self.connection.sendfile(source, offset, count) # os.sendfile() where available
+
+    def end_headers(self):
+        for keyword, value in self.extra_headers:
+            self.send_header(keyword, value)
+        super().end_headers()
+
+    def do_GET(self):
+        path = self.path.split('?',1)[0]
+        if path not in self.endpoints:
+            return super().do_GET()
+        now = monotonic()
+        if path not in self.cache or now - self.cache[path][0] >= self.endpoint_ttl:
+            self.cache[path] = (now,) + self.endpoints[path]()
+        _, ctype, body = self.cache[path]
+        self.send_response(200)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_request(self, code='-', size='-'):
+        if self.path.split('?',1)[0] not in self.endpoints: # don't log every scrape of monitoring tools
+            super().log_request(code, size)
 
     def translate_path(self, path):
         """Translate a /-separated PATH to the local filename syntax."""
@@ -44,44 +328,267 @@ class HTTPRequestHandler(SimpleHTTPRequestHandler):
             path += '/'
         return path
 
-def walk_failed(e):
-    raise
+# Cache of the scans of client folders, to rebuild their manifest without walking the whole tree again.
+MANIFEST_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'yoke')
+MANIFEST_CACHE_VERSION = 2
+# Files are also served by the hash of their contents, under this path, as immutable resources.
+HASH_PREFIX = '/by-hash/'
+# The whole tree is also served as a single zip archive, built when first requested and kept for every
+# version of the tree: at BUNDLE_PATH for the current version, and at BUNDLE_PREFIX + tree hash + '.zip'.
+BUNDLE_PATH = '/bundle.zip'
+BUNDLE_PREFIX = '/bundle/'
+BUNDLES_DIR = os.path.join(MANIFEST_CACHE_DIR, 'bundles')
+BUNDLES_KEPT = 8
+# Compressed variants of text files, in a folder per client path (see variants_path()),
+# named after the hash of the original, so that each is made only once.
+VARIANTS_DIR = os.path.join(MANIFEST_CACHE_DIR, 'variants')
+COMPRESSIBLE = ('.html', '.htm', '.js', '.css', '.svg', '.json', '.txt')
+def gzip_compress(data):
+    # gzip.compress(data, 9, mtime=0) needs Python 3.8. Without a timestamp, the output only depends on data.
+    output = io.BytesIO()
+    with gzip.GzipFile(fileobj=output, mode='wb', compresslevel=9, mtime=0) as f:
+        f.write(data)
+    return output.getvalue()
+
+# Content codings, in order of preference, with their file suffix and compression function.
+ENCODINGS = [('gzip', '.gz', gzip_compress)]
+if brotli is not None:
+    ENCODINGS.insert(0, ('br', '.br', lambda data: brotli.compress(data, quality=11)))
+
+def client_path_key(path):
+    return hashlib.sha1(os.path.abspath(path).encode(errors='surrogateescape')).hexdigest()[:16]
+
+def manifest_cache_path(path):
+    return os.path.join(MANIFEST_CACHE_DIR, 'manifest-{}.json'.format(client_path_key(path)))
+
+def variants_path(path):
+    # Each client folder has its own variants, so pruning those of one never removes those served for another.
+    return os.path.join(VARIANTS_DIR, client_path_key(path))
+
+def scan_folder(path, rel, cached, scanned):
+    # Scan folder rel of path and its subfolders into scanned: relative path -> {'fingerprint', 'folders', 'files'},
+    # where files maps every file name to its [size, mtime, inode, SHA-256 of the contents].
+    # A folder whose inode and mtime (its fingerprint) didn't change has the same entries as before,
+    # so it isn't listed again; only its files are stat'ed, since editing a file in place leaves the folder alone.
+    # Files are only hashed again if their size, mtime or inode changed.
+    folder = os.path.join(path, rel) if rel else path
+    st = os.stat(folder)
+    fingerprint = [st.st_ino, st.st_mtime_ns]
+    old = cached.get(rel)
+    oldfiles = old['files'] if old is not None else {}
+    if old is not None and old['fingerprint'] == fingerprint:
+        folders, names = old['folders'], list(old['files'])
+    else:
+        folders, names = [], []
+        for entry in sorted(os.scandir(folder), key=lambda entry: entry.name):
+            if entry.is_dir(follow_symlinks=False):
+                folders.append(entry.name)
+            elif entry.is_dir():
+                pass # links to folders aren't followed, as by os.walk(), which could loop forever
+            elif entry.name != 'manifest.json':
+                names.append(entry.name)
+    files = {}
+    for name in names:
+        try:
+            st = os.stat(os.path.join(folder, name))
+        except FileNotFoundError:
+            # Removed since the last scan, which may not have changed the mtime of the folder in the same second.
+            return scan_folder(path, rel, {}, scanned)
+        stats = [st.st_size, st.st_mtime, st.st_ino]
+        if name in oldfiles and oldfiles[name][:3] == stats:
+            files[name] = oldfiles[name]
+        else:
+            files[name] = stats + [hash_file(os.path.join(folder, name))]
+    scanned[rel] = {'fingerprint': fingerprint, 'folders': folders, 'files': files}
+    for name in folders:
+        scan_folder(path, rel + '/' + name if rel else name, cached, scanned)
+
+def hash_file(filename):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def compress_variants(filename, digest, folder):
+    # Compressed variants of a file, kept in folder: encoding -> path, creating the missing ones.
+    # Variants that wouldn't save at least a tenth of the size are recorded as empty files, and not used.
+    variants = {}
+    data = None
+    for encoding, suffix, compress in ENCODINGS:
+        variant = os.path.join(folder, digest + suffix)
+        if not os.path.exists(variant):
+            if data is None:
+                with open(filename, 'rb') as f:
+                    data = f.read()
+            compressed = compress(data)
+            os.makedirs(folder, exist_ok=True)
+            fd, temp = tempfile.mkstemp(dir=folder, prefix='.' + digest)
+            with os.fdopen(fd, 'wb') as f:
+                if len(compressed) < 0.9 * len(data):
+                    f.write(compressed)
+            os.chmod(temp, 0o644)
+            os.replace(temp, variant)
+        if os.path.getsize(variant) > 0:
+            variants[encoding] = variant
+    return variants
+
+def prune_variants(index, folder):
+    # Remove the compressed variants in folder of files that are gone or changed: those not in index.
+    try:
+        entries = list(os.scandir(folder))
+    except OSError:
+        return
+    for entry in entries:
+        digest = entry.name.split('.', 1)[0]
+        if digest and digest not in index: # names starting with a dot are variants being written
+            try:
+                os.unlink(entry.path)
+            except OSError:
+                pass
+
+def write_if_changed(filename, contents):
+    # Replace the file atomically, so that readers never see it half written, and only if its contents differ.
+    # Returns whether it was written.
+    try:
+        with open(filename) as f:
+            if f.read() == contents:
+                return False
+    except (OSError, UnicodeDecodeError):
+        pass
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(filename), prefix='.' + os.path.basename(filename) + '.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(contents)
+        os.chmod(temp, 0o644) # mkstemp() makes it private
+        os.replace(temp, filename)
+    except BaseException:
+        os.unlink(temp)
+        raise
+    return True
+
+def build_bundle(path, manifest):
+    # Path of the zip archive of the tree described by manifest, building it unless it exists already.
+    # Returns None if a file changed since the manifest was written, as the archive wouldn't match it.
+    filename = os.path.join(BUNDLES_DIR, manifest['tree'] + '.zip')
+    if os.path.exists(filename):
+        return filename
+    os.makedirs(BUNDLES_DIR, exist_ok=True)
+    fd, temp = tempfile.mkstemp(dir=BUNDLES_DIR, prefix='.' + manifest['tree'])
+    complete = False
+    try:
+        with os.fdopen(fd, 'wb') as f, zipfile.ZipFile(f, 'w') as archive:
+            for file in manifest['files']:
+                filepath = os.path.join(path, *file.split('/'))
+                with open(filepath, 'rb') as source:
+                    st = os.fstat(source.fileno())
+                    data = source.read()
+                if hashlib.sha256(data).hexdigest() != manifest['hashes'][file]:
+                    break
+                info = zipfile.ZipInfo(file, max(localtime(st.st_mtime)[:6], (1980, 1, 1, 0, 0, 0)))
+                info.external_attr = (st.st_mode & 0xffff) << 16
+                info.compress_type = zipfile.ZIP_DEFLATED if file.lower().endswith(COMPRESSIBLE) else zipfile.ZIP_STORED
+                archive.writestr(info, data)
+            else:
+                archive.writestr('manifest.json', json.dumps(manifest))
+                complete = True
+        if complete:
+            os.chmod(temp, 0o644)
+            os.replace(temp, filename)
+    except FileNotFoundError:
+        pass # a file was removed
+    finally:
+        if not complete:
+            os.unlink(temp)
+    if not complete:
+        return None
+    # Keep only the most recent bundles.
+    bundles = sorted((entry for entry in os.scandir(BUNDLES_DIR) if entry.name.endswith('.zip')),
+        key=lambda entry: entry.stat().st_mtime, reverse=True)
+    for entry in bundles[BUNDLES_KEPT:]:
+        os.unlink(entry.path)
+    return filename
 
 def check_webserver(path):
+    # Scan the client folder and write its manifest, which lists its folders and files with their
+    # content hashes, and a hash of the whole tree. Returns the index of the files by content hash:
+    # hash -> (relative path, size, mtime, compressed variants), for serving them under HASH_PREFIX
+    # and compressed, along with the contents of the manifest.
     print('Checking files on webserver… ', end='')
+    cachefile = manifest_cache_path(path)
+    variants_dir = variants_path(path)
+    try:
+        with open(cachefile) as f:
+            cache = json.load(f)
+        cached = cache['folders'] if cache.get('version') == MANIFEST_CACHE_VERSION else {}
+    except (OSError, ValueError, KeyError, AttributeError):
+        cached = {}
+    scanned = {}
+    scan_folder(path, '', cached, scanned)
     manifestContents = {
         'folders': [], 'files': [],
         'size': 0,
         'mtime': 0,
+        'hashes': {}, # file -> SHA-256 of its contents, also available at HASH_PREFIX + hash
+        'tree': '', # SHA-256 of every file name and hash, which changes if anything does
+        'hashpath': HASH_PREFIX,
+        'bundle': '', # path of a zip archive of the whole tree (and this manifest)
     }
-    for root, dirs, files in os.walk(path, onerror=walk_failed):
-        # If the folder separator is not a forward slash, convert it to a forward slash anyways.
-        # It's what Android expects.
-        if root != path:
-            manifestContents['folders'].append(os.path.relpath(root, start=path).replace(os.sep, '/'))
-        for entry in files:
-            if entry != 'manifest.json':
-                entrypath = os.path.join(root, entry)
-                entrystat = os.stat(entrypath)
-                manifestContents['files'].append(os.path.relpath(entrypath, start=path).replace(os.sep, '/'))
-                manifestContents['size'] += entrystat.st_size
-                manifestContents['mtime'] = max(manifestContents['mtime'], entrystat.st_mtime)
+    index = {}
+    tree = hashlib.sha256()
+    # Folders in the order of a top-down walk; paths always use forward slashes, as Android expects.
+    for rel in sorted(scanned):
+        if rel:
+            manifestContents['folders'].append(rel)
+        for name, (size, mtime, ino, digest) in sorted(scanned[rel]['files'].items()):
+            file = rel + '/' + name if rel else name
+            manifestContents['files'].append(file)
+            manifestContents['hashes'][file] = digest
+            manifestContents['size'] += size
+            manifestContents['mtime'] = max(manifestContents['mtime'], mtime)
+            tree.update('{}\0{}\n'.format(file, digest).encode(errors='surrogateescape'))
+            variants = {}
+            if name.lower().endswith(COMPRESSIBLE):
+                try:
+                    variants = compress_variants(os.path.join(path, *file.split('/')), digest, variants_dir)
+                except OSError:
+                    pass # served uncompressed
+            index[digest] = (file, size, mtime, variants)
+    manifestContents['tree'] = tree.hexdigest()
+    prune_variants(index, variants_dir)
+    manifestContents['bundle'] = BUNDLE_PREFIX + manifestContents['tree'] + '.zip'
     print('OK.')
+    if scanned != cached:
+        try:
+            os.makedirs(MANIFEST_CACHE_DIR, exist_ok=True)
+            write_if_changed(cachefile, json.dumps({'version': MANIFEST_CACHE_VERSION, 'folders': scanned}))
+        except OSError:
+            pass # the cache only saves time
     try:
         print('Writing manifest… ', end='')
-        with open(os.path.join(path, 'manifest.json'), 'w') as manifest:
-            json.dump(manifestContents, manifest)
+        if write_if_changed(os.path.join(path, 'manifest.json'), json.dumps(manifestContents)):
             print('OK.')
+        else:
+            print('unchanged.')
     except IOError:
         print('failed.\nYoke could not write a new `manifest.json` file to the webserver.\n'
             'You may play with an outdated file, but layouts downloaded from this server may be broken.')
+    return index, manifestContents
 
-def run_webserver(port, path):
+def run_webserver(port, path, endpoints=None, hashes=None, manifest=None):
     print('Starting webserver on ', port, path)
     class RH(HTTPRequestHandler):
         basepath = path
+        cache = {}
+    if endpoints is not None:
+        RH.endpoints = endpoints
+    if hashes is not None:
+        RH.hashes = hashes
+        RH.paths = {entry[0]: digest for digest, entry in hashes.items()}
+    if manifest is not None:
+        RH.manifest = manifest
     try:
-        with socketserver.TCPServer(('', port), RH) as httpd:
+        with ThreadingTCPServer(('', port), RH) as httpd:
             httpd.serve_forever()
     except OSError:
         # No need for passing OSError to the main thread, just end this thread.
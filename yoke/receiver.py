@@ -0,0 +1,174 @@
+# Batch reception of UDP datagrams into preallocated buffers.
+#
+# A receiver reads up to `count` datagrams per call into one buffer of `count` slots of `size` bytes,
+# and exposes them as memoryviews of that buffer, so that they can be dispatched without copying.
+# The views are only valid until the next call to receive(). Reading still allocates a few small
+# objects per datagram (the results of the socket calls, the views), which Python can't avoid.
+# On Linux, MMsgReceiver reads them with a single recvmmsg() system call, through ctypes.
+# Elsewhere, or if that fails, Receiver reads them one by one with recv_into().
+import ctypes
+import socket
+import struct
+from platform import system
+from time import time
+
+# From asm-generic/socket.h (the Python socket module doesn't define it); also the type of its control message.
+SO_TIMESTAMPNS = 35
+timespec_struct = struct.Struct('@ll')
+MSG_DONTWAIT = 0x40
+EAGAIN = (11, 35) # Linux, BSD
+sockaddr_in_struct = struct.Struct('!HH4s8x') # sa_family (in host order, unused here), port, address
+
+class Receiver:
+    def __init__(self, sock, size, count=32, timestamps=False):
+        self.sock = sock
+        self.size = size
+        self.count = count
+        self.timestamps = timestamps # whether the socket has SO_TIMESTAMPNS enabled
+        self.buffer = bytearray(size * count)
+        view = memoryview(self.buffer)
+        self.slots = [view[i * size:(i + 1) * size] for i in range(count)]
+        self.lengths = [0] * count
+        self.addresses = [None] * count
+        self.times = [0.0] * count # arrival times (time() times), from the kernel if available
+        self.tread = 0.0 # when the last datagram was read
+        self.ancbufsize = socket.CMSG_SPACE(timespec_struct.size) if timestamps else 0 # timestamps are Linux only
+
+    def message(self, i):
+        return self.slots[i][:self.lengths[i]]
+
+    def receive(self):
+        # Read the datagrams waiting in the socket, up to count. Returns how many were read.
+        # The socket is non-blocking, so the datagrams are read within microseconds: without kernel
+        # timestamps, they all get the time at the end of the loop.
+        n = 0
+        while n < self.count:
+            try:
+                if self.timestamps:
+                    nbytes, ancdata, flags, address = self.sock.recvmsg_into([self.slots[n]], self.ancbufsize)
+                else:
+                    nbytes, address = self.sock.recvfrom_into(self.slots[n])
+                    ancdata = ()
+            except (socket.timeout, socket.error):
+                break
+            t = None
+            for level, type, data in ancdata:
+                if level == socket.SOL_SOCKET and type == SO_TIMESTAMPNS:
+                    sec, nsec = timespec_struct.unpack(data)
+                    t = sec + nsec * 1e-9
+            self.lengths[n] = nbytes
+            self.addresses[n] = address
+            self.times[n] = t
+            n += 1
+        t = self.tread = time()
+        for i in range(n):
+            if self.times[i] is None or self.times[i] > t:
+                self.times[i] = t
+        return n
+
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.POINTER(iovec)),
+        ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int),
+    ]
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr), ('msg_len', ctypes.c_uint)]
+
+# struct cmsghdr: size_t cmsg_len, int cmsg_level, int cmsg_type, then the data, aligned like a size_t.
+cmsghdr_struct = struct.Struct('@Nii')
+# Offset of the data (socket.CMSG_LEN() doesn't exist on Windows, which doesn't use MMsgReceiver anyway).
+CMSG_DATA = socket.CMSG_LEN(0) if hasattr(socket, 'CMSG_LEN') else None
+
+try:
+    libc = ctypes.CDLL(None, use_errno=True)
+    recvmmsg = libc.recvmmsg
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+except (OSError, AttributeError, TypeError):
+    recvmmsg = None
+
+PEERS_MAX = 1024
+
+class MMsgReceiver(Receiver):
+    # Reads the datagrams with one recvmmsg() call. Only IPv4 peers are supported.
+    def __init__(self, sock, size, count=32, timestamps=False):
+        super().__init__(sock, size, count, timestamps)
+        self.fd = sock.fileno()
+        self.names = (ctypes.c_char * (sockaddr_in_struct.size * count))()
+        self.control = (ctypes.c_char * max(self.ancbufsize * count, 1))()
+        self.iovecs = (iovec * count)()
+        self.headers = (mmsghdr * count)()
+        self.base = ctypes.c_char.from_buffer(self.buffer) # also keeps the buffer from being resized
+        base = ctypes.addressof(self.base)
+        for i in range(count):
+            self.iovecs[i].iov_base = base + i * size
+            self.iovecs[i].iov_len = size
+            header = self.headers[i].msg_hdr
+            header.msg_name = ctypes.addressof(self.names) + i * sockaddr_in_struct.size
+            header.msg_iov = ctypes.pointer(self.iovecs[i])
+            header.msg_iovlen = 1
+            if timestamps:
+                header.msg_control = ctypes.addressof(self.control) + i * self.ancbufsize
+            header.msg_namelen = sockaddr_in_struct.size
+            header.msg_controllen = self.ancbufsize
+        self.used = 0 # headers filled by the last call
+        self.peers = {} # raw sockaddr_in -> (host, port), so that known peers cost no new tuple (up to PEERS_MAX)
+
+    def receive(self):
+        headers = self.headers
+        for i in range(self.used):
+            # The kernel overwrote these with the actual lengths.
+            headers[i].msg_hdr.msg_namelen = sockaddr_in_struct.size
+            headers[i].msg_hdr.msg_controllen = self.ancbufsize
+        n = self.used = recvmmsg(self.fd, headers, self.count, MSG_DONTWAIT, None)
+        if n < 0:
+            self.used = 0
+            errno = ctypes.get_errno()
+            if errno in EAGAIN:
+                return 0
+            raise OSError(errno, 'recvmmsg failed')
+        t = self.tread = time()
+        names = self.names
+        for i in range(n):
+            self.lengths[i] = headers[i].msg_len
+            key = names[i * sockaddr_in_struct.size:i * sockaddr_in_struct.size + 8]
+            address = self.peers.get(key) # the key costs a small bytes object, but no new address tuple
+            if address is None:
+                if len(self.peers) >= PEERS_MAX:
+                    self.peers.clear() # e.g. phones reconnecting from new ports, or spoofed sources
+                _, port, host = sockaddr_in_struct.unpack_from(names, i * sockaddr_in_struct.size)
+                address = self.peers[key] = (socket.inet_ntoa(host), port)
+            self.addresses[i] = address
+            self.times[i] = t
+            if self.timestamps:
+                self.times[i] = min(self.timestamp(i), t)
+        return n
+
+    def timestamp(self, i):
+        # Kernel arrival time of datagram i, from its control messages.
+        offset = i * self.ancbufsize
+        end = offset + self.headers[i].msg_hdr.msg_controllen
+        while offset + cmsghdr_struct.size <= end:
+            length, level, type = cmsghdr_struct.unpack_from(self.control, offset)
+            if length < cmsghdr_struct.size:
+                break
+            if level == socket.SOL_SOCKET and type == SO_TIMESTAMPNS:
+                sec, nsec = timespec_struct.unpack_from(self.control, offset + CMSG_DATA)
+                return sec + nsec * 1e-9
+            offset += socket.CMSG_SPACE(length - CMSG_DATA)
+        return time()
+
+def make_receiver(sock, size, count=32, timestamps=False):
+    # The fastest receiver available for this socket.
+    if recvmmsg is not None and system() == 'Linux' and sock.family == socket.AF_INET:
+        return MMsgReceiver(sock, size, count, timestamps)
+    return Receiver(sock, size, count, timestamps)
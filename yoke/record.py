@@ -0,0 +1,95 @@
+# Binary recordings of the messages received by Service, for debugging and replaying sessions.
+#
+# A recording is a sequence of fixed-size records. The first one is the file header; every other
+# record holds a receive time, a peer number, flags and up to PAYLOAD bytes of a message.
+# Longer messages (e.g. big layouts) continue in the following records, and the first message
+# of every peer is preceded by a PEER record with its address as "host:port".
+import mmap
+import struct
+
+MAGIC = b'YOKEREC1'
+RECORD_SIZE = 64
+header_struct = struct.Struct('<8sH')
+record_struct = struct.Struct('<dHBB') # time, peer, flags, length of the payload in this record
+PAYLOAD = RECORD_SIZE - record_struct.size
+
+# flags
+CONTINUED = 0x01 # the message continues in the next record
+PEER = 0x02 # the payload is the address of a new peer
+
+class RecordingError(Exception): pass
+
+class Recorder:
+    # Appends records to a file from a preallocated buffer, written out whenever it fills up
+    # and on flush(), so that recording costs no allocation and no system call per message.
+    def __init__(self, path, records=1024):
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            header = bytearray(RECORD_SIZE)
+            header_struct.pack_into(header, 0, MAGIC, RECORD_SIZE)
+            self.file.write(header)
+        self.buffer = bytearray(RECORD_SIZE * records)
+        self.view = memoryview(self.buffer)
+        self.offset = 0
+        self.peers = {} # address -> peer number
+
+    def record(self, t, address, m):
+        peer = self.peers.get(address)
+        if peer is None:
+            peer = self.peers[address] = len(self.peers)
+            self.append(t, peer, PEER, '{}:{}'.format(*address).encode())
+        self.append(t, peer, 0, m)
+
+    def append(self, t, peer, flags, m):
+        n = len(m)
+        start = 0
+        while True:
+            if self.offset == len(self.buffer):
+                self.flush()
+            chunk = min(n - start, PAYLOAD)
+            more = CONTINUED if start + chunk < n else 0
+            record_struct.pack_into(self.buffer, self.offset, t, peer, flags | more, chunk)
+            offset = self.offset + record_struct.size
+            if start == 0 and not more:
+                self.buffer[offset:offset + chunk] = m
+            else:
+                self.buffer[offset:offset + chunk] = memoryview(m)[start:start + chunk]
+            self.offset += RECORD_SIZE
+            start += chunk
+            if not more:
+                break
+
+    def flush(self):
+        if self.offset:
+            self.file.write(self.view[:self.offset])
+            self.file.flush()
+            self.offset = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+def read_records(path):
+    # Generator of (time, address, message) for every message in a recording, in order.
+    # The file is memory-mapped, so that even long recordings start replaying right away.
+    with open(path, 'rb') as f:
+        if f.seek(0, 2) == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            magic, size = header_struct.unpack_from(mm, 0)
+            if magic != MAGIC or size != RECORD_SIZE:
+                raise RecordingError('{} is not a Yoke recording'.format(path))
+            peers = {}
+            parts = {}
+            for offset in range(RECORD_SIZE, len(mm) - RECORD_SIZE + 1, RECORD_SIZE):
+                t, peer, flags, n = record_struct.unpack_from(mm, offset)
+                start = offset + record_struct.size
+                parts.setdefault(peer, []).append(mm[start:start + n])
+                if flags & CONTINUED:
+                    continue
+                m = b''.join(parts.pop(peer))
+                if flags & PEER:
+                    host, _, port = m.decode().rpartition(':')
+                    peers[peer] = (host, int(port))
+                else:
+                    yield t, peers.get(peer, ('', peer)), m
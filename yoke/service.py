@@ -1,18 +1,31 @@
-from time import sleep, perf_counter
+from time import perf_counter, sleep, time
 from platform import system
 import atexit
+import gc
+import selectors
+import signal
 import sys
+import os
+import traceback
+import mmap
+import multiprocessing
 from yoke import events as EVENTS
+from yoke.layout import ABS_EVENTS, InvalidLayoutError, Layout, compile_layout
+from yoke.curves import AXIS_MAX
+from yoke.record import Recorder
+from yoke.receiver import SO_TIMESTAMPNS, make_receiver
+from yoke.metrics import Metrics, SessionTable, prometheus, RECEIVED, REPORTS, STALE, DROPPED, MALFORMED, EMITS
+from yoke.metrics import STATE, HOST, PORT, TCONNECT, SESSION_RECEIVED, SESSION_EMITS, CONTROLS, FREE, CONNECTED, KEPT
 from yoke.network import *
 import struct
+import json
+from array import array
 from glob import glob
-from threading import Thread
+from threading import Thread, current_thread, main_thread
 if system() == 'Windows':
     from yoke.vjoy.vjoydevice import VjoyDevice
 elif system() == 'Linux':
-    import uinput
-
-ABS_EVENTS = [getattr(EVENTS, n) for n in dir(EVENTS) if n.startswith('ABS_')]
+    import fcntl
 
 # Basic error handlers used (and explained) by the script bin/yoke:
 class TCPPortError(RuntimeError): pass
@@ -20,45 +33,257 @@ class DeviceNameTakenError(RuntimeError): pass
 class UInputDisabledError(Exception): pass
 class MalformedMessageError(Exception): pass
 
+# Constants from linux/input.h and linux/uinput.h:
+EV_SYN = 0x00
+SYN_REPORT = 0
+BUS_VIRTUAL = 0x06
+UI_DEV_CREATE = 0x5501
+UI_DEV_DESTROY = 0x5502
+UI_SET_EVBIT = 0x40045564
+UI_SET_BITS = {
+    0x01: 0x40045565, # UI_SET_KEYBIT
+    0x02: 0x40045566, # UI_SET_RELBIT
+    0x03: 0x40045567, # UI_SET_ABSBIT
+}
+UINPUT_MAX_NAME_SIZE = 80
+ABS_CNT = 0x40
+
+# Claim of a device id whose worker process died while a phone used it (see Service.supervise).
+ORPHANED = 0xff
+
+class UInputDevice:
+    # Drop-in replacement for python-uinput's Device that talks to /dev/uinput directly.
+    # Events are queued in a preallocated buffer of input_event structs, and syn() sends them
+    # together with the trailing SYN_REPORT in a single os.write().
+    # For testing, any writable file descriptor (e.g. a pipe) can be passed as fd, along with a fake ioctl.
+
+    # struct input_event: struct timeval (left at zero, the kernel stamps the event), u16 type, u16 code, s32 value
+    event_struct = struct.Struct('@llHHi')
+    # struct uinput_user_dev: name, struct input_id, ff_effects_max, absmax, absmin, absfuzz, absflat
+    setup_struct = struct.Struct('@{}s4HI{}i'.format(UINPUT_MAX_NAME_SIZE, 4 * ABS_CNT))
+
+    def __init__(self, events, name='python-uinput', bustype=BUS_VIRTUAL, vendor=0, product=0, version=0,
+            fd=None, ioctl=None):
+        self.fd = os.open('/dev/uinput', os.O_WRONLY | os.O_NONBLOCK) if fd is None else fd
+        self.ioctl = fcntl.ioctl if ioctl is None else ioctl
+        absinfo = [0] * (4 * ABS_CNT) # absmax, absmin, absfuzz, absflat
+        types = set()
+        try:
+            for event in events:
+                type, code = event[:2]
+                if type not in types:
+                    self.ioctl(self.fd, UI_SET_EVBIT, type)
+                    types.add(type)
+                self.ioctl(self.fd, UI_SET_BITS[type], code)
+                if len(event) > 2:
+                    absinfo[code], absinfo[ABS_CNT + code], absinfo[2*ABS_CNT + code], absinfo[3*ABS_CNT + code] = (
+                        event[3], event[2], event[4], event[5])
+            os.write(self.fd, self.setup_struct.pack(name.encode()[:UINPUT_MAX_NAME_SIZE - 1],
+                bustype, vendor, product, version, 0, *absinfo))
+            self.ioctl(self.fd, UI_DEV_CREATE)
+        except:
+            if fd is None:
+                os.close(self.fd)
+            raise
+        # Room for every registered control plus the SYN_REPORT:
+        self.buffer = bytearray(self.event_struct.size * (len(events) + 1))
+        self.view = memoryview(self.buffer)
+        self.offset = 0
+
+    def emit(self, event, value, syn=True):
+        if self.offset + self.event_struct.size >= len(self.buffer):
+            self.write() # the buffer is full, but leave room for the SYN_REPORT
+        self.event_struct.pack_into(self.buffer, self.offset, 0, 0, event[0], event[1], value)
+        self.offset += self.event_struct.size
+        if syn:
+            self.syn()
+
+    def syn(self):
+        self.event_struct.pack_into(self.buffer, self.offset, 0, 0, EV_SYN, SYN_REPORT, 0)
+        self.offset += self.event_struct.size
+        self.write()
+
+    def write(self):
+        os.write(self.fd, self.view[:self.offset])
+        self.offset = 0
+
+    def destroy(self):
+        self.ioctl(self.fd, UI_DEV_DESTROY)
+        os.close(self.fd)
+
+class NullBackend:
+    # Backend that discards every event, to exercise the hot path without /dev/uinput.
+    def __init__(self, events, name='Yoke', bustype=BUS_VIRTUAL):
+        self.events = events
+
+    def emit(self, event, value, syn=True):
+        pass
+
+    def syn(self):
+        pass
+
+    def destroy(self):
+        pass
+
+class RecordingBackend(NullBackend):
+    # Backend that records every emitted event, SYN_REPORTs included, into a preallocated ring buffer
+    # of (timestamp, type, code, value) records. Once the buffer is full, the oldest records are overwritten.
+    capacity = 1 << 16
+    record_struct = struct.Struct('@dHHi')
+
+    def __init__(self, events, name='Yoke', bustype=BUS_VIRTUAL):
+        super().__init__(events, name, bustype)
+        self.buffer = bytearray(self.record_struct.size * self.capacity)
+        self.count = 0 # total number of recorded events, including overwritten ones
+
+    def emit(self, event, value, syn=True):
+        self.record_struct.pack_into(self.buffer, (self.count % self.capacity) * self.record_struct.size,
+            perf_counter(), event[0], event[1], value)
+        self.count += 1
+        if syn:
+            self.syn()
+
+    def syn(self):
+        self.emit((EV_SYN, SYN_REPORT), 0, False)
+
+    def records(self):
+        # Recorded events still in the buffer, oldest first.
+        first = max(self.count - self.capacity, 0)
+        return [self.record_struct.unpack_from(self.buffer, (i % self.capacity) * self.record_struct.size)
+            for i in range(first, self.count)]
+
+    def clear(self):
+        self.count = 0
+
+# Backends must provide the same interface as UInputDevice: they are created with the list of events
+# to register, a name and a bus type, and implement emit(event, value, syn), syn() and destroy().
+BACKENDS = {
+    'uinput': UInputDevice,
+    'null': NullBackend,
+    'recording': RecordingBackend,
+}
+DEFAULT_BACKEND = 'uinput'
+
 class Device:
-    def __init__(self, id=1, name='Yoke', events=(), bytestring=b''):
+    def __init__(self, id=1, name='Yoke', events=(), bytestring=b'', backend=DEFAULT_BACKEND, layout=None, curves=None):
         self.name = name + '-' + str(id)
         for fn in glob('/sys/class/input/js*/device/name'):
             with open(fn) as f:
                 fname = f.read().split()[0]  # need to split because there seem to be newlines
-                if name == fname:
-                    raise DeviceNameTakenError(name)
+                if self.name == fname:
+                    raise DeviceNameTakenError(self.name)
 
-        # set range (0, 0x7fff) for abs events
-        self.events = events
+        if layout is None:
+            layout = Layout(events)
+        self.layout = layout
+        self.events = layout.events
         self.bytestring = bytestring
-        self.inStruct = struct.Struct('>x' + ''.join(['H' if e in ABS_EVENTS else '?' for e in events]))
-        events = [e + (0, 0x7fff, 0, 0) if e in ABS_EVENTS else e for e in events]
+        self.inStruct = layout.inStruct
+        # last emitted value of every control; -1 (never emitted) forces the first report through
+        self.state = array('i', [-1] * len(self.events))
+        # last status report, as received; its header byte is never 0xFF, so the first report can't match
+        self.raw = bytearray(self.inStruct.size)
+        self.raw[0] = 0xff
+        self.rawview = memoryview(self.raw)
+        # response curve lookup table of every control, if any
+        self.tables = curves.tables(self.events) if curves is not None else None
 
-        BUS_VIRTUAL = 0x06
         try:
-            self.device = uinput.Device(events, name, BUS_VIRTUAL)
+            self.device = BACKENDS[backend](layout.capabilities, self.name, BUS_VIRTUAL)
         except Exception as e:
             raise UInputDisabledError(*e.args)
 
     def emit(self, d, v):
-        if d not in self.events:
-            print('Event {d} has not been registered… yet?'.format(d))
+        if d not in self.layout.eventset:
+            print('Event {} has not been registered… yet?'.format(EVENTS.name(d)))
         self.device.emit(d, int(v), False)
 
     def flush(self):
         self.device.syn()
 
+    def update(self, values):
+        # Emit only the controls that changed since the last report, and skip SYN if none did.
+        # Returns the number of emitted events.
+        state = self.state
+        tables = self.tables
+        emitted = 0
+        for i, v in enumerate(values):
+            if tables is not None and tables[i] is not None:
+                v = tables[i][v & AXIS_MAX]
+            if state[i] != v:
+                state[i] = v
+                self.device.emit(self.events[i], int(v), False)
+                emitted += 1
+        if emitted:
+            self.device.syn()
+        return emitted
+
+    def update_from(self, buffer):
+        # Like update(), straight from a status report in a buffer (e.g. a memoryview of the receive buffer),
+        # which must hold at least inStruct.size bytes. Rather than decoding the whole report, compare it
+        # byte by byte with the previous one and only decode the controls that changed: a report identical
+        # to the previous one, as phones send when nothing moves, costs a single comparison, and others
+        # only allocate the values of the axes that changed.
+        raw = self.raw
+        if len(buffer) != len(raw):
+            buffer = buffer[:len(raw)]
+        if buffer == raw:
+            return 0
+        if raw[0] != 0:
+            # No previous report (see reset()): decode it all.
+            self.rawview[:] = buffer
+            return self.update(self.inStruct.unpack_from(raw))
+        state = self.state
+        tables = self.tables
+        events = self.events
+        device = self.device
+        emitted = 0
+        for i, first, second in self.layout.fields:
+            if second is None:
+                if buffer[first] == raw[first]:
+                    continue
+                v = 1 if buffer[first] else 0
+            else:
+                if buffer[first] == raw[first] and buffer[second] == raw[second]:
+                    continue
+                v = buffer[first] << 8 | buffer[second]
+                if tables is not None and tables[i] is not None:
+                    v = tables[i][v & AXIS_MAX]
+            if state[i] != v:
+                state[i] = v
+                device.emit(events[i], v, False)
+                emitted += 1
+        self.rawview[:] = buffer
+        if emitted:
+            device.syn()
+        return emitted
+
+    def reset(self):
+        # Return every control to its resting position (sticks centered, pedals and buttons released),
+        # with the raw values the phone sends at rest: response curves aren't applied.
+        self.raw[0] = 0xff
+        state = self.state
+        for i, v in enumerate(self.layout.neutral):
+            if state[i] != v:
+                state[i] = v
+                self.device.emit(self.events[i], v, False)
+        self.device.syn()
+
     def close(self):
-        if self.bytestring != b'':
+        if self.device is not None:
             self.device.destroy()
+            self.device = None
             self.bytestring = b''
 
 
 # Override on Windows
 if system() == 'Windows':
+    # vJoy is the only backend available on Windows.
+    BACKENDS = {'vjoy': VjoyDevice}
+    DEFAULT_BACKEND = 'vjoy'
+
     class Device:
-        def __init__(self, id=1, name='Yoke', events=(), bytestring=b''):
+        def __init__(self, id=1, name='Yoke', events=(), bytestring=b'', backend=DEFAULT_BACKEND, layout=None, curves=None):
             super().__init__()
             self.name = name + '-' + str(id)
             self.device = VjoyDevice(id)
@@ -82,6 +307,8 @@ if system() == 'Windows':
             self.inStruct = struct.Struct(self.inStruct)
             self.axes = [0,] * 15
             self.buttons = 0
+            self.tables = curves.tables(events) if curves is not None else None
+            self.neutral = (layout if layout is not None else Layout(events)).neutral
         def emit(self, d, v):
             if d is not None:
                 if d[0] == 0x03: #analog axis
@@ -113,59 +340,186 @@ if system() == 'Windows':
 
             # This allows a very simple emit() definition:
             self.buttons = 0
+        def update(self, values):
+            # vJoy always takes the whole state at once, so there is nothing to gain from deltas.
+            for i, (ev, val) in enumerate(zip(self.events, values)):
+                if self.tables is not None and self.tables[i] is not None:
+                    val = self.tables[i][val & AXIS_MAX]
+                self.emit(ev, val)
+            self.flush()
+            return len(self.events)
+        def update_from(self, buffer):
+            return self.update(self.inStruct.unpack_from(buffer))
+        def reset(self):
+            for ev, val in zip(self.events, self.neutral):
+                self.emit(ev, val)
+            self.flush()
         def close(self):
             self.device.close()
             self.bytestring = b''
 
+class Session:
+    # Connection with one phone, identified by its address, and the virtual device it drives.
+    def __init__(self, address, devid):
+        self.address = address
+        self.devid = devid
+        self.dev = None # created when the phone sends its layout
+        self.trecv = self.tconnect = perf_counter()
+        self.slot = None # slot of the device id in Service.table
+        self.treport = None # arrival time of the last status report
+        self.interval = None # time between the last two status reports
+        self.expiry = None # when the device of a disconnected phone is destroyed, if kept in the pool
+
+    def close(self):
+        if self.dev is not None:
+            self.dev.close()
+            self.dev = None
+
 class Service:
     sock = None
     info = None
     name = None
     devid = None
-    # dt should be noticeably lower than the app's polling rate,
-    # at least on Windows:
-    dt = 0.006
+    sel = None
+    receiver = None
+    worker = None # index of this worker process, if running several
+    claims = None
+    sockets = () # sockets of the worker processes, kept by the parent process
+    recorder = None
+    shared = None
     tdelta_max = 2
 
-    def __init__(self, devname='Yoke', devid='1', iface='auto', port=0, bufsize=64, client_path=DEFAULT_CLIENT_PATH):
-        self.dev = Device(devid, devname)
+    def __init__(self, devname='Yoke', devid='1', iface='auto', port=0, bufsize=64, client_path=DEFAULT_CLIENT_PATH, coalesce=False, backend=DEFAULT_BACKEND, workers=1, linger=0, curves=None, record=None, stats=0, timestamps=True, batch=32):
+        # devid can also be a list of ids: then the service serves one phone per id.
+        self.devids = list(devid) if isinstance(devid, (list, tuple)) else [devid]
+        self.backend = backend
+        self.curves = curves
         self.name = devname
-        self.devid = devid
+        self.devid = self.devids[0]
         self.iface = iface
         self.port = port
         self.bufsize = bufsize
         self.client_path = client_path
-        self.status_length = bufsize
+        self.coalesce = coalesce
+        self.sessions = {} # peer address -> Session
+        self.workers = workers
+        self.pids = {} # worker process id -> worker index
+        # Devices of disconnected phones are kept for `linger` seconds, in case a phone reconnects
+        # with the same layout: then it gets a ready device back instead of a hot-plugged one.
+        self.linger = linger
+        self.pool = [] # sessions of disconnected phones whose device is kept
+        self.record = record # path of the file to record received messages to
+        self.metrics = Metrics()
+        self.table = SessionTable(len(self.devids))
+        self.tstart = time()
+        self.stats_interval = stats # seconds between summary lines of the metrics, 0 for none
+        self.worker_metrics = [] # metrics of every worker process, if running several
+        # Ask the kernel for the arrival time of every datagram (Linux only), so that time spent
+        # in the socket buffer, e.g. while the loop was busy, counts in the latency too.
+        self.timestamps = timestamps and system() == 'Linux'
+        self.batch = batch # datagrams read per system call at most
+        # Fail early if virtual devices can't be created at all:
+        for devid in self.devids:
+            Device(devid, devname, backend=backend).close()
 
-    def preprocess(self, message):
+    def preprocess(self, message, dev):
+        if dev is None:
+            self.metrics.counters[MALFORMED] += 1
+            raise MalformedMessageError(len(message), 1) # no layout yet, only the header byte is expected
         try:
-            v = self.dev.inStruct.unpack(message)
+            v = dev.inStruct.unpack(message)
         except struct.error:
-            raise MalformedMessageError(len(message), self.dev.inStruct.size)
+            self.metrics.counters[MALFORMED] += 1
+            raise MalformedMessageError(len(message), dev.inStruct.size)
         return v
 
+    def open_socket(self, reuseport=False):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.bufsize)  # small buffer for low latency
+        if reuseport:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if self.timestamps:
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+            except OSError:
+                self.timestamps = False
+        sock.bind((self.iface, self.port))
+        sock.setblocking(False)
+        return sock
+
+    def use_socket(self, sock):
+        # Instead of polling the socket every few milliseconds, sleep in select()
+        # until a datagram arrives or the next connection deadline passes.
+        self.sock = sock
+        self.sel = selectors.DefaultSelector()
+        self.sel.register(sock, selectors.EVENT_READ)
+        self.receiver = make_receiver(sock, self.bufsize, self.batch, self.timestamps)
+
+    def preprocess_batch(self, buffer, dev):
+        # Decode a contiguous buffer of status reports of dev's layout at once (needs NumPy, see yoke.batch).
+        from yoke import batch
+        return batch.decode(dev.layout, buffer)
+
     def run(self):
         atexit.register(self.close_atexit)
 
         if self.iface == 'auto':
             self.iface = get_ip_address()
 
+        if self.workers > 1 and not (hasattr(socket, 'SO_REUSEPORT') and hasattr(os, 'fork')):
+            print('Worker processes are not supported on this system, running a single process.')
+            self.workers = 1
+        if self.workers > len(self.devids):
+            # More workers than devices wouldn't serve more phones.
+            print('Only {} device ids available, running {} worker processes.'.format(len(self.devids), len(self.devids)))
+            self.workers = len(self.devids)
+
         # open udp socket on random available port
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.bufsize)  # small buffer for low latency
-        self.sock.bind((self.iface, self.port))
-        self.sock.settimeout(0)
+        self.sock = self.open_socket(reuseport=self.workers > 1)
         adr, port = self.sock.getsockname()
         self.port = port
 
-        check_webserver(self.client_path)
-        self.thread = Thread(target=run_webserver, args=(self.port, self.client_path), daemon=True)
+        if self.workers > 1:
+            # Every worker reads its own socket bound to the same port, and the kernel spreads peers among them.
+            # This process opens them all and keeps them open, without reading them: the kernel picks the socket
+            # of a peer by its position in the group of sockets, so a worker that dies and is restarted must
+            # get the same socket back, otherwise the peers of the other workers would move too.
+            self.sockets = [self.sock] + [self.open_socket(reuseport=True) for i in range(1, self.workers)]
+            self.sock = None
+            # Device ids are shared: a byte per id, in memory shared with the workers, tells which worker uses it
+            # (its index + 1), if any.
+            self.claims = mmap.mmap(-1, len(self.devids))
+            self.claims_lock = multiprocessing.Lock()
+            # Likewise, every worker keeps its metrics in shared memory, where this process adds them up,
+            # and describes its sessions in a shared table.
+            self.shared = mmap.mmap(-1, Metrics.size * self.workers + SessionTable.size(len(self.devids)))
+            shared = memoryview(self.shared)
+            self.worker_metrics = [Metrics(shared[i * Metrics.size:(i + 1) * Metrics.size])
+                for i in range(self.workers)]
+            self.table = SessionTable(len(self.devids), shared[self.workers * Metrics.size:])
+            for index in range(self.workers):
+                self.pids[self.spawn_worker(index)] = index
+        else:
+            self.use_socket(self.sock)
+            if self.record is not None:
+                self.recorder = Recorder(self.record)
+
+        if hasattr(signal, 'SIGUSR1') and current_thread() is main_thread():
+            # `kill -USR1 PID` prints a summary of the metrics.
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.print_stats())
+
+        hashes, manifest = check_webserver(self.client_path)
+        endpoints = {
+            '/metrics': lambda: ('text/plain; version=0.0.4', self.prometheus().encode()),
+            '/status.json': lambda: ('application/json', json.dumps(self.status()).encode()),
+        }
+        self.thread = Thread(target=run_webserver, args=(self.port, self.client_path, endpoints, hashes, manifest), daemon=True)
         self.thread.start()
 
-        # create zeroconf service
+        # create zeroconf service, shared by all the sessions
         stype = '_yoke._udp.local.'
-        netname = socket.gethostname() + '-' + self.dev.name
-        fullname = netname + '.' + stype
+        self.netname = socket.gethostname() + '-' + self.name + '-' + str(self.devid)
+        fullname = self.netname + '.' + stype
         self.info = ServiceInfo(
             stype,
             fullname,
@@ -174,89 +528,387 @@ class Service:
             properties={},
             server=fullname
         )
-        zeroconf.register_service(self.info, ttl=10)
+        get_zeroconf().register_service(self.info, ttl=10)
 
         if not self.thread.is_alive():
             raise TCPPortError
 
+        self.listen()
+        if self.workers > 1:
+            self.supervise()
+        else:
+            self.serve()
+
+    def serve(self):
+        # Everything allocated so far lives as long as the service: keep it out of the garbage collections,
+        # so that those triggered while serving only go through the objects allocated since.
+        gc.collect()
+        if hasattr(gc, 'freeze'): # Python 3.7+
+            gc.freeze()
+        tstats = perf_counter() + self.stats_interval
+        previous = self.metrics.counters.tolist()
         while True:
-            trecv = perf_counter()
-            irecv = 0
-            connection = None
-            print('\nTo connect select "{}" on your device,'.format(netname))
-            print('or connect manually to "{}:{}"'.format(adr, port))
-            print('Press Ctrl+C to exit.')
-
-            while True:
-                try:
-                    m, address = self.sock.recvfrom(self.status_length)
-
-                    if connection is None and m[0] != 255:
-                        print('Connected to ', address)
-                        connection = address
-
-                    if connection == address:
-                        trecv = perf_counter()
-                        irecv = 0
-                        # The first byte of a message tells us its general content:
-                        # NULL BYTE: status report from the game controller.
-                        if (m[0] == 0):
-                            for ev, val in zip(self.dev.events, self.preprocess(m)):
-                                self.dev.emit(ev, val)
-                            self.dev.flush()
-                        # 0xFF BYTE: request for disconnection. Same effect as a timeout.
-                        elif (m[0] == 255):
-                            print('Disconnected by request. Device destroyed.')
-                            self.status_length = self.bufsize
-                            self.dev.close()
-                            break
-                        # ANYTHING ELSE: information for a new layout.
-                        # If there is no registered device, it registers a new device.
-                        # If the device is already registered, check bytestrings. If they appear to match, ignore.
-                        # If they don't match, print an error message and don't acknowledge.
-                        else:
-                            if self.dev.bytestring == b'':
-                                v = m.decode(encoding='UTF-8')
-                                for key, value in EVENTS.ALIAS.items():
-                                    v = v.replace(key, value)
-                                v = v.split(',')
-                                try:
-                                    events = [getattr(EVENTS, n) for n in v]
-                                    self.dev = Device(self.devid, self.name, events, m)
-                                    print('New control layout chosen.')
-                                    self.status_length = self.dev.inStruct.size
-                                    # HOTFIXES FOR WINDOWS.
-                                    # Its websocket seem to lose packets on a predictable fashion, or create latency.
-                                    # Until the root cause for this is found:
-                                    if system() == 'Windows':
-                                        # Windows doesn't acknowledge new layout registry messages after the first
-                                        # for unclear reasons (possibly related to a mismatch between expected and
-                                        # actual message length).
-                                        # Until this is fixed, delay timeouts until receiving the first status report:
-                                        trecv = trecv + 86400 # 24 hours will do.
-                                except AttributeError:
-                                    print('Error. Invalid layout discarded.')
-                            else:
-                                if not self.dev.bytestring.startswith(m):
-                                    print('Error. Must unregister device before registering another.')
+            # Block until a datagram arrives. While connected, wake up no later than the earliest
+            # timeout deadline (or pool expiry, or summary line); while waiting for connections, block indefinitely.
+            deadlines = [s.trecv + self.tdelta_max for s in self.sessions.values()] + [s.expiry for s in self.pool]
+            if self.stats_interval > 0:
+                deadlines.append(tstats)
+            if deadlines:
+                timeout = max(min(deadlines) - perf_counter(), 0)
+            else:
+                timeout = None
+            if self.sel.select(timeout):
+                for m, address, t in self.receive():
+                    self.handle(m, address, t)
+            elif self.recorder is not None:
+                self.recorder.flush() # nothing received until a deadline, a good time to write
 
-                    else:
-                        pass  # ignore packets from other addresses
+            now = perf_counter()
+            for session in [s for s in self.sessions.values() if now - s.trecv >= self.tdelta_max]:
+                print('Timeout ({} seconds), disconnected.'.format(self.tdelta_max))
+                print('  (received {} packets per second)'.format(int(session.slot[SESSION_RECEIVED]/(now - session.tconnect))))
+                self.disconnect(session)
+            for session in [s for s in self.pool if now >= s.expiry]:
+                self.expire(session)
+            if self.stats_interval > 0 and now >= tstats:
+                print(self.stats_prefix() + self.metrics.summary(previous, now - tstats + self.stats_interval))
+                previous = self.metrics.counters.tolist()
+                tstats = now + self.stats_interval
+
+    def spawn_worker(self, index):
+        pid = os.fork()
+        if pid != 0:
+            return pid
+
+        # Worker process: serve the peers the kernel sends to this socket.
+        # It must never return into the caller of run(), so it always leaves with os._exit().
+        code = 0
+        try:
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+            self.worker = index
+            self.pids = {}
+            self.metrics = self.worker_metrics[index]
+            self.metrics.tstart = time()
+            self.worker_metrics = []
+            self.info = None # the zeroconf registration belongs to the parent process
+            for i, sock in enumerate(self.sockets):
+                if i != index:
+                    sock.close()
+            sock = self.sockets[index]
+            self.sockets = ()
+            self.use_socket(sock)
+            if self.record is not None:
+                self.recorder = Recorder('{}.{}'.format(self.record, index))
+            self.serve()
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            self.close()
+            sys.stdout.flush()
+            os._exit(code)
+
+    def supervise(self):
+        # Restart workers that die, e.g. after an unexpected error.
+        while True:
+            pid, status = os.wait()
+            index = self.pids.pop(pid, None)
+            if index is not None:
+                print('Worker {} exited, restarting it.'.format(index))
+                for i in range(len(self.devids)):
+                    if self.claims[i] == index + 1:
+                        # Its devices are gone, but the phones it served keep sending status reports
+                        # (to the same socket), and never their layout again: leave the ids of connected
+                        # phones to the restarted worker, which recreates their devices (see adopt()).
+                        connected = self.table.slots[i][STATE] == CONNECTED and self.table.layout(i)
+                        self.claims[i] = ORPHANED if connected else 0
+                        self.table.slots[i][STATE] = FREE
+                sleep(1)
+                self.pids[self.spawn_worker(index)] = index
+
+    def listen(self):
+        if self.worker is not None:
+            return # only the parent process prints instructions
+        print('\nTo connect select "{}" on your device,'.format(self.netname))
+        print('or connect manually to "{}:{}"'.format(self.iface, self.port))
+        if self.workers > 1:
+            print('Serving {} devices from {} worker processes.'.format(len(self.devids), self.workers))
+        elif len(self.devids) > 1:
+            print('{} of {} devices in use.'.format(len(self.sessions), len(self.devids)))
+        print('Press Ctrl+C to exit.')
+
+    def stats(self):
+        # Snapshot of the metrics, of every worker process together if running several.
+        return self.total_metrics().snapshot()
 
-                except (socket.timeout, socket.error):
-                    pass
+    def total_metrics(self):
+        if self.worker_metrics:
+            return Metrics.total(self.worker_metrics)
+        return self.metrics
 
-                tdelta = perf_counter() - trecv
+    def status(self):
+        # Everything monitoring needs to know about the service, as a dictionary ready for JSON.
+        # It only reads counters that the receive loop updates without locking, from copies, so that
+        # building it (in the webserver thread) never makes the loop wait.
+        metrics = [Metrics.total([m]) for m in self.worker_metrics or [self.metrics]]
+        status = dict(name=self.name, port=self.port, uptime=time() - self.tstart, workers=self.workers,
+            metrics=Metrics.total(metrics).snapshot(),
+            devices=self.table.snapshot(['{}-{}'.format(self.name, devid) for devid in self.devids]))
+        if self.worker_metrics:
+            status['worker_metrics'] = [m.snapshot() for m in metrics]
+        return status
 
-                if connection is not None and tdelta > self.tdelta_max:
-                    print('Timeout ({} seconds), disconnected.'.format(self.tdelta_max))
-                    print('  (listened {} times per second)'.format(int(irecv/tdelta)))
-                    self.status_length = self.bufsize
-                    if self.dev.bytestring != b'': self.dev.close()
+    def prometheus(self):
+        # The same, in Prometheus text format, with a "worker" label when running several workers.
+        if self.worker_metrics:
+            metrics = [({'worker': i}, Metrics.total([m])) for i, m in enumerate(self.worker_metrics)]
+        else:
+            metrics = [({}, Metrics.total([self.metrics]))]
+        devices = self.table.snapshot(['{}-{}'.format(self.name, devid) for devid in self.devids])
+        return prometheus(metrics, devices, time() - self.tstart)
+
+    def stats_prefix(self):
+        return 'Worker {}: '.format(self.worker) if self.worker is not None else 'Stats: '
+
+    def print_stats(self):
+        print(self.stats_prefix() + self.total_metrics().summary(), flush=True)
+
+    def claim_id(self):
+        # First device id not used by any session, in any worker process, or else of a session left
+        # by a worker process that died.
+        if self.claims is None:
+            used = [s.devid for s in self.sessions.values()] + [s.devid for s in self.pool]
+            return next((devid for devid in self.devids if devid not in used), None)
+        with self.claims_lock:
+            for claim in (0, ORPHANED):
+                for i, devid in enumerate(self.devids):
+                    if self.claims[i] == claim:
+                        self.claims[i] = self.worker + 1
+                        return devid
+        return None
+
+    def adopt(self, address, t):
+        # Take over the session of a phone that was served by a worker process that died, if the
+        # status report from unknown peer `address` is from such a phone. Returns the session, if any.
+        if self.claims is None:
+            return None
+        host = int.from_bytes(socket.inet_aton(address[0]), 'big')
+        with self.claims_lock:
+            for i, slot in enumerate(self.table.slots):
+                if self.claims[i] == ORPHANED and slot[HOST] == host and slot[PORT] == address[1]:
+                    self.claims[i] = self.worker + 1
                     break
+            else:
+                return None
+        print('Resuming the session of ', address)
+        layout = self.table.layout(i)
+        session = self.sessions[address] = Session(address, self.devids[i])
+        self.publish(session, CONNECTED)
+        self.handle(layout, address, t) # as if the phone sent its layout again
+        return self.sessions.get(address) # unless its device couldn't be created
+
+    def release_id(self, devid):
+        if self.claims is not None:
+            self.claims[self.devids.index(devid)] = 0
+
+    def publish(self, session, state):
+        # Describe a session in the slot of its device id, which it takes over from the slot of its previous id.
+        slot = self.table.slots[self.devids.index(session.devid)]
+        if session.slot is None:
+            slot[HOST] = int.from_bytes(socket.inet_aton(session.address[0]), 'big')
+            slot[PORT] = session.address[1]
+            slot[TCONNECT] = time()
+            slot[SESSION_RECEIVED] = slot[SESSION_EMITS] = 0
+        elif session.slot is not slot:
+            slot[:] = session.slot
+            session.slot[STATE] = FREE
+        slot[STATE] = state
+        slot[CONTROLS] = len(session.dev.events) if session.dev is not None else 0
+        self.table.set_layout(self.devids.index(session.devid), session.dev.bytestring if session.dev is not None else b'')
+        session.slot = slot
+
+    def connect(self, address):
+        devid = self.claim_id()
+        if devid is None and self.pool:
+            # Every id is taken, but some by devices nobody uses: destroy the one unused the longest.
+            self.expire(min(self.pool, key=lambda s: s.expiry))
+            devid = self.claim_id()
+        if devid is None:
+            return None
+        print('Connected to ', address)
+        session = self.sessions[address] = Session(address, devid)
+        self.publish(session, CONNECTED)
+        return session
+
+    def disconnect(self, session):
+        del self.sessions[session.address]
+        if self.linger > 0 and session.dev is not None:
+            session.dev.reset()
+            session.expiry = perf_counter() + self.linger
+            self.pool.append(session)
+            self.publish(session, KEPT)
+            print('Device kept for {} seconds.'.format(self.linger))
+        else:
+            self.publish(session, FREE)
+            session.close()
+            self.release_id(session.devid)
+            print('Device destroyed.')
+        if self.recorder is not None:
+            self.recorder.flush()
+        self.listen()
+
+    def expire(self, parked):
+        self.pool.remove(parked)
+        self.publish(parked, FREE)
+        parked.close()
+        self.release_id(parked.devid)
 
-                sleep(self.dt)
-                irecv += 1
+    def reuse(self, session, layout):
+        # Hand a session the device of a disconnected phone with the same layout, preferably
+        # the device of the same host. Returns whether there was such a device.
+        candidates = [s for s in self.pool if s.dev.events == layout.events]
+        if not candidates:
+            return False
+        parked = min(candidates, key=lambda s: (s.address[0] != session.address[0], s.expiry))
+        self.pool.remove(parked)
+        self.release_id(session.devid)
+        session.devid, session.dev = parked.devid, parked.dev
+        return True
+
+    def receive(self):
+        # Read the datagrams queued in the socket, as many as the receiver reads at once (see yoke.receiver).
+        # In coalescing mode, read every datagram queued in the socket instead, and drop each
+        # status report that is superseded by a newer one from the same peer.
+        # Layout and disconnection messages are always kept, in their original order.
+        # Returns (message, address, arrival time) tuples, with arrival times as perf_counter() times:
+        # from the kernel timestamp of the datagram if available, or when it was read.
+        # Messages are memoryviews of the buffer of the receiver, valid until the next call.
+        counters = self.metrics.counters
+        receiver = self.receiver
+        batch = []
+        latest = {}
+        while True:
+            n = receiver.receive()
+            if n == 0:
+                break
+            # Arrival times use the system clock: translate them to perf_counter() times.
+            offset = perf_counter() - time()
+            for i in range(n):
+                m = receiver.message(i)
+                address = receiver.addresses[i]
+                tarrival = receiver.times[i]
+                t = tarrival + offset
+                if self.timestamps:
+                    self.metrics.queue.record(int((receiver.tread - tarrival) * 1e6))
+                counters[RECEIVED] += 1
+                if self.recorder is not None:
+                    self.recorder.record(tarrival, address, m)
+                if len(m) == 0:
+                    counters[DROPPED] += 1  # empty datagram
+                elif m[0] == 0 and self.coalesce:
+                    if address in latest:
+                        batch[latest[address]] = None
+                        counters[STALE] += 1
+                    latest[address] = len(batch)
+                    batch.append((m, address, t))
+                else:
+                    if self.coalesce:
+                        latest.pop(address, None)
+                    batch.append((m, address, t))
+            if not self.coalesce or n < receiver.count:
+                break
+            # More datagrams are waiting, to be read into the same buffer: copy the messages kept so far.
+            batch = [b if b is None else (bytes(b[0]),) + b[1:] for b in batch]
+        return [b for b in batch if b is not None]
+
+    def handle(self, m, address, t=None):
+        # t: when the message was read from the socket (perf_counter() time), now if not given.
+        session = self.sessions.get(address)
+        if session is None:
+            if m[0] == 255:
+                self.metrics.counters[DROPPED] += 1
+                return  # disconnection request from a peer we're not connected to
+            if m[0] == 0:
+                session = self.adopt(address, t)
+                if session is None:
+                    self.metrics.counters[DROPPED] += 1
+                    return  # status report from a peer without a session, e.g. refused while every device is in use
+            else:
+                session = self.connect(address)
+            if session is None:
+                self.metrics.counters[DROPPED] += 1
+                return  # ignore packets from other addresses while every device is in use
+
+        session.trecv = t = perf_counter() if t is None else t
+        # The first byte of a message tells us its general content:
+        # NULL BYTE: status report from the game controller.
+        if (m[0] == 0):
+            metrics = self.metrics
+            dev = session.dev
+            if dev is None or len(m) < dev.inStruct.size:
+                # Drop it: a stray or spoofed datagram must not stop the service, nor the other sessions.
+                metrics.counters[MALFORMED] += 1
+                if dev is None:
+                    print('Status report without a valid layout, disconnected.', end=' ')
+                    self.disconnect(session) # don't keep the device id for a phone that can't use it
+                return
+            slot = session.slot
+            slot[SESSION_RECEIVED] += 1
+            if session.treport is not None:
+                interval = t - session.treport
+                if session.interval is not None:
+                    metrics.jitter.record(int(abs(interval - session.interval) * 1e6))
+                session.interval = interval
+            session.treport = t
+            # Anything after the expected length is ignored, like when reading just that length from the socket.
+            emitted = dev.update_from(m)
+            metrics.counters[EMITS] += emitted
+            slot[SESSION_EMITS] += emitted
+            metrics.counters[REPORTS] += 1
+            metrics.latency.record(int((perf_counter() - t) * 1e6))
+        # 0xFF BYTE: request for disconnection. Same effect as a timeout.
+        elif (m[0] == 255):
+            print('Disconnected by request.', end=' ')
+            self.disconnect(session)
+        # ANYTHING ELSE: information for a new layout.
+        # If there is no registered device, it registers a new device.
+        # If the device is already registered, check bytestrings. If they appear to match, ignore.
+        # If they don't match, print an error message and don't acknowledge.
+        else:
+            m = bytes(m) # kept by the device, and a key of the layout cache
+            if session.dev is None:
+                try:
+                    layout = compile_layout(m)
+                    if self.reuse(session, layout):
+                        session.dev.bytestring = m
+                        print('Known control layout, reusing device {}.'.format(session.dev.name))
+                    else:
+                        session.dev = Device(session.devid, self.name, layout.events, m, self.backend, layout, self.curves)
+                        print('New control layout chosen.')
+                    self.publish(session, CONNECTED)
+                    # HOTFIXES FOR WINDOWS.
+                    # Its websocket seem to lose packets on a predictable fashion, or create latency.
+                    # Until the root cause for this is found:
+                    if system() == 'Windows':
+                        # Windows doesn't acknowledge new layout registry messages after the first
+                        # for unclear reasons (possibly related to a mismatch between expected and
+                        # actual message length).
+                        # Until this is fixed, delay timeouts until receiving the first status report:
+                        session.trecv = session.trecv + 86400 # 24 hours will do.
+                except InvalidLayoutError:
+                    self.metrics.counters[MALFORMED] += 1
+                    print('Error. Invalid layout discarded.')
+                except (DeviceNameTakenError, UInputDisabledError) as err:
+                    # E.g. another Yoke process uses the same id: only this phone can't be served.
+                    self.metrics.counters[DROPPED] += 1
+                    print('Error. Could not create the device ({}: {}), disconnected.'.format(type(err).__name__,
+                        ', '.join(map(str, err.args))), end=' ')
+                    self.disconnect(session)
+            else:
+                if not session.dev.bytestring.startswith(m[:session.dev.inStruct.size]):
+                    print('Error. Must unregister device before registering another.')
 
     def close_atexit(self):
         print('Yoke: Unregistering zeroconf service…')
@@ -264,9 +916,25 @@ class Service:
 
     def close(self):
         atexit.unregister(self.close_atexit)
-        if self.dev.bytestring != b'':
-            self.dev.close()
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+        self.pids.clear()
+        for session in list(self.sessions.values()) + self.pool:
+            session.close()
+        self.sessions.clear()
+        self.pool.clear()
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+        if self.sel is not None:
+            self.sel.close()
         if self.sock is not None:
             self.sock.close()
+        for sock in self.sockets:
+            sock.close()
         if self.info is not None:
-            zeroconf.unregister_service(self.info)
+            get_zeroconf().unregister_service(self.info)